@@ -38,6 +38,8 @@ import sys
 import argparse
 import time
 import tempfile
+import json
+import multiprocessing
 
 if sys.version_info[0] == 2:
   import ucsftool
@@ -52,6 +54,8 @@ DESC = '\nIntegrated UCSF Peak Picker v0.1\n\t\
 NMRGLUE_PATH = 'nmrglue-0.7'
 UCSFTOOL_PATH = '.'
 LOG_FILE = os.path.join(tempfile.gettempdir(), 'process.log')
+DONE_FILE = os.path.join(tempfile.gettempdir(), 'done')
+STATUS_FILE = None
 
 def print_log(*args):
     msg = ''
@@ -64,6 +68,49 @@ def print_log(*args):
     f.write(msg + '\n')
     f.close()
     print(*args)
+    sys.stdout.flush()
+
+
+# Progress events for the GUI: one line of EVENT_PREFIX and a JSON object on
+# stdout, e.g. '@ipick {"event": "stage", "stage": "noise"}'. The event names
+# are 'start', 'stage', 'done' and 'error'.
+EVENT_PREFIX = '@ipick '
+
+def print_event(event, **fields):
+    fields['event'] = event
+    line = json.dumps(fields, sort_keys=True)
+    print(EVENT_PREFIX + line)
+    sys.stdout.flush()
+    if STATUS_FILE:
+        f = open(STATUS_FILE, 'w')
+        f.write(line + '\n')
+        f.close()
+
+
+def parse_event(line):
+    """Return the event dictionary of an output line, or None"""
+    if not line.startswith(EVENT_PREFIX):
+        return None
+    try:
+        return json.loads(line[len(EVENT_PREFIX):])
+    except ValueError:
+        return None
+
+
+def set_job_dir(job_dir):
+    """Keep the log, status and done files of this run in job_dir
+
+    Runs with different job directories do not share any file, so they can
+    run at the same time. The status file holds the last event.
+    """
+    global LOG_FILE, DONE_FILE, STATUS_FILE
+    if not os.path.isdir(job_dir):
+        os.makedirs(job_dir)
+    LOG_FILE = os.path.join(job_dir, 'process.log')
+    DONE_FILE = os.path.join(job_dir, 'done')
+    STATUS_FILE = os.path.join(job_dir, 'status')
+    if hasattr(ucsftool, 'set_log_file'):
+        ucsftool.set_log_file(LOG_FILE)
 
 
 def parse_args():
@@ -129,11 +176,41 @@ def parse_args():
         help='Peak picking software {e.g. ucsftool or nmrglue}',
         default='ucsftool'
     )
+    parg.add_argument(
+        '-e', '--engine', type=str,
+        help='UCSFTOOL peak detection engine {python, numpy or stream}',
+        default='python'
+    )
+    parg.add_argument(
+        '--stream-memory', type=int,
+        help='Memory limit in MB for the stream engine (default 256)',
+        default=None
+    )
+    parg.add_argument(
+        '--mem-limit', type=str,
+        help='Memory iPick may use to cache the spectrum, in MB or with a K, M or G suffix (e.g. 4G). The IPICK_MEM_LIMIT environment variable sets the same.',
+        default=None
+    )
+    parg.add_argument(
+        '--local-noise',
+        help='Scale the threshold by the noise of each region (tile). Requires NumPy.',
+        action='store_true'
+    )
+    parg.add_argument(
+        '-M', '--mmap',
+        help='Memory-map the spectrum instead of loading it in memory.',
+        action='store_true'
+    )
     parg.add_argument(
         '-S', '--sign', type=int,
         help='Peak sign. Choose between 1, 0, and -1. \n0 means both positive and negative peaks.',
         default=0
     )
+    parg.add_argument(
+        '-j', '--job-dir', type=str,
+        help='Directory for the log, status and done files of this run (and the peak list if -o is not given). Default is the temporary directory shared by all runs.',
+        default=None
+    )
     parg.add_argument(
         '-p', '--print_info',
         help='Print UCSF information.',
@@ -143,24 +220,168 @@ def parse_args():
     return args
 
 
+def estimate_noise(tool):
+    """Noise of the opened spectrum (sampled median on older UCSFTOOL)
+
+    The statistics cache next to the spectrum is reused if available.
+    """
+    if hasattr(tool, 'get_stats'):
+        return tool.get_stats(full=False)['noise']
+    if hasattr(tool, 'estimate_noise'):
+        return tool.estimate_noise()
+    return tool.sample_noise(100)
+
+
 def get_noise_level(in_filename):
-    ut.ucsf_open(in_filename, nproc=1, cache_mode=False)
-    noise = ut.sample_noise(100)
+    # older UCSFTOOL (python 2) treats any true cache_mode as True
+    if hasattr(ut, 'lazy_cache'):
+        ut.ucsf_open(in_filename, nproc=1, cache_mode='lazy')
+    else:
+        ut.ucsf_open(in_filename, nproc=1, cache_mode=False)
+    noise = estimate_noise(ut)
+    ut.ucsf_close()
     multthresh = 8.5
     noiselevel = abs(noise * multthresh)
     return noiselevel
 
 
+def pick_peaks(tool, noiselevel, res, sign=0, peak_count=None,
+               software='ucsftool', engine='python', memory_limit=None,
+               local_noise=False):
+    """Pick peaks of a spectrum opened by tool in this process
+
+    res: grid buffers of the axes
+    local_noise: scale noiselevel by the noise of each tile
+    Returns peak shifts and heights sorted by heights.
+    """
+    ndim = len(tool.axis_header_list)
+    if software == 'ucsftool':
+        print_log('Using UCSFTOOL to detect local maxima.')
+        print_log('Resolution setting: ', res[0])
+        print_log('Detection engine: ', engine)
+        if local_noise:
+            print_log('Using local noise levels.')
+        if engine == 'python' and memory_limit is None and not local_noise:
+            grid_peaks, _ = tool.find_peaks(noiselevel, res, sign=sign,
+                                            verbose=True)
+        else:
+            grid_peaks, _ = tool.find_peaks(noiselevel, res, sign=sign,
+                                            verbose=True, engine=engine,
+                                            memory_limit=memory_limit,
+                                            local_noise=local_noise)
+    else:
+        print_log('Using NMRGLUE to detect local maxima.')
+
+        grid_peaks = []
+        try:
+            import nmrglue as ng
+            _, data = ng.sparky.read(tool.get_filename())
+            pthres = noiselevel
+            nthres = -1 * noiselevel
+            if sign == 1:
+                nthres = None
+            elif sign == -1:
+                pthres = None
+            # https://nmrglue.readthedocs.io/en/latest/reference/generated/nmrglue.analysis.peakpick.pick.html
+            # msep = 
+            grid_peaks = ng.analysis.peakpick.pick(data, pthres=pthres, nthres=nthres, algorithm='connected')
+        except ImportError:
+            print_log('Importing NMRGLUE failed. Using UCSFtool instead.')
+
+    if peak_count:
+        peak_count = min(peak_count, len(grid_peaks))
+    else:
+        peak_count = len(grid_peaks)
+    print_log('Detected peak count: ' + str(len(grid_peaks)))
+
+    # interpolation and get adjusted data heights
+    print_log('Using UCSFTOOL to interpolate and obtain adjusted heights.')
+    peak_list, hts_list = [], []
+
+    grid_pts = []
+    for grid_peak in grid_peaks:
+        grid_pt = ()
+        for i in range(ndim):
+            grid_pt += (int(grid_peak[i]),)
+        grid_pts.append(grid_pt)
+
+    # with local noise levels, the peaks already passed the threshold of
+    # their tiles, which can be lower than noiselevel
+    cut_level = noiselevel
+    if local_noise and software == 'ucsftool':
+        cut_level = None
+    if hasattr(tool, 'get_interpolated_data_many'):
+        shifts_list, value_list = tool.get_interpolated_data_many(
+            grid_pts, noise_level=cut_level)
+    else:
+        shifts_list, value_list = [], []
+        for grid_pt in grid_pts:
+            shifts, value = tool.get_interpolated_data(grid_pt,
+                                                       noise_level=cut_level)
+            shifts_list.append(shifts)
+            value_list.append(value)
+
+    for shifts, value in zip(shifts_list, value_list):
+        if shifts == None:
+            continue
+        peak_list.append(shifts)
+        hts_list.append(value)
+
+    # sort by adjusted heights
+    print_log('Using UCSFTOOL to sort and filter peaks.')
+    return tool.filter_peaks_by_count(peak_list, hts_list, peak_count)
+
+
+def pick(in_filename, out_filename=None, res=1, sign=0, threshold=None,
+         multthresh=8.5, peak_count=None, nproc=1, software='ucsftool',
+         engine='python', memory_limit=None, cache_mode=True,
+         local_noise=False):
+    """Pick peaks of a UCSF file without the command line
+
+    res: grid buffer for all axes or a list of grid buffers of the axes
+    threshold: noise level. If not given, sampled noise * multthresh.
+    Writes a SPARKY peak list if out_filename is given.
+    Returns peak shifts and heights sorted by heights.
+    """
+    tool = ucsftool.ucsfTool()
+    if software != 'ucsftool':
+        cache_mode = False
+    if tool.ucsf_open(in_filename, nproc=nproc, cache_mode=cache_mode) == 0:
+        return [], []
+    if threshold:
+        noiselevel = abs(threshold)
+    else:
+        noiselevel = abs(estimate_noise(tool) * multthresh)
+    print_log('Noise level: ' + str(noiselevel))
+    if not isinstance(res, (list, tuple)):
+        res = [res] * len(tool.axis_header_list)
+    sort_peaks, sort_hts = pick_peaks(tool, noiselevel, res, sign, peak_count,
+                                      software, engine, memory_limit,
+                                      local_noise)
+    if out_filename and len(sort_peaks) != 0:
+        tool.write_sparky_peaks(out_filename, sort_peaks, sort_hts)
+        print_log('%d peaks written in %s' % (len(sort_peaks), out_filename))
+    tool.ucsf_close()
+    return sort_peaks, sort_hts
+
+
 def main():
     args = parse_args()
+    if args.job_dir:
+        set_job_dir(args.job_dir)
     print_log(DESC)
     if not args.input:
         print_log('Input file not specified. "iPick.py -h" to show options.')
+        print_event('error', message='Input file not specified.')
         return
     in_filename = args.input
+    print_event('start', input=in_filename)
 
     if args.output != '[user_input].list':
         out_filename = args.output
+    elif args.job_dir:
+        pre, _ = os.path.splitext(os.path.basename(in_filename))
+        out_filename = os.path.join(args.job_dir, pre + '.list')
     else:
         pre, _ = os.path.splitext(in_filename)
         out_filename = pre + '.list'
@@ -171,10 +392,26 @@ def main():
         sys.path.append(args.ucsftool)
 
 
+    if args.mem_limit and hasattr(ucsftool, 'set_memory_limit'):
+        mem_limit = ucsftool.parse_memory_size(args.mem_limit)
+        if mem_limit is None:
+            print_log('Invalid memory limit: ' + args.mem_limit)
+            print_event('error', message='Invalid memory limit.')
+            return
+        ucsftool.set_memory_limit(mem_limit)
+
     if args.software == 'ucsftool':
-        ut.ucsf_open(in_filename, nproc=args.nproc)
+        if args.mmap:
+            opened = ut.ucsf_open(in_filename, nproc=args.nproc, cache_mode='mmap')
+        elif hasattr(ut, 'lazy_cache'):
+            opened = ut.ucsf_open(in_filename, nproc=args.nproc, cache_mode='lazy')
+        else:
+            opened = ut.ucsf_open(in_filename, nproc=args.nproc, cache_mode=True)
     else:
-        ut.ucsf_open(in_filename, nproc=args.nproc, cache_mode=False)
+        opened = ut.ucsf_open(in_filename, nproc=args.nproc, cache_mode=False)
+    if opened == 0:
+        print_event('error', message='Could not open the input file.')
+        return
 
     if args.print_info:
         ut.print_file_info()
@@ -183,13 +420,15 @@ def main():
 
     if os.path.exists(out_filename) and not args.overwrite:
         print_log('Output file %s already exists.' % (out_filename))
+        print_event('error', message='Output file already exists.')
         return
 
     ndim = len(ut.axis_header_list)
+    print_event('stage', stage='noise')
     print_log('Using UCSFTOOL to sample noise level.')
 
     peak_sign = int(args.sign)
-    noise = ut.sample_noise(100)
+    noise = estimate_noise(ut)
 
     if args.threshold:
         noiselevel = abs(args.threshold)
@@ -198,105 +437,42 @@ def main():
 
 
     print_log('Noise level: ' + str(noiselevel))
+    peak_count = None
     if args.number:
         peak_count = args.number
         print_log('Peak count: ' + str(peak_count))
 
-    if args.software == 'ucsftool':
-        print_log('Using UCSFTOOL to detect local maxima.')
-        if args.ress:
-            res = list(map(lambda x: int(args.ress[x]), range(len(args.ress))))
-        else:
-            res = [args.res] * ndim
-        print_log('Resolution setting: ', res[0])
-        #grid_peaks, _ = ut.find_peaks(noiselevel, res, sign=peak_sign, verbose=True)
-        import runpy
-        if sys.version_info[0] == 2:
-            mname = 'ucsftool'
-        else:
-            mname = 'ucsftool3'
-        m = runpy.run_module(mname, {'ut': ut,
-                                    'func': 'find_peaks',
-                                    'noiselevel': noiselevel,
-                                    'res': res,
-                                    'sign': peak_sign,
-                                    'verbose': True}, '__main__')
-        grid_peaks = m['grid_peaks']
-        grid_hts = m['grid_hts']
-    else:
-        print_log('Using NMRGLUE to detect local maxima.')
-
-        grid_peaks = []
-        try:
-            import nmrglue as ng
-            _, data = ng.sparky.read(in_filename)
-            pthres = noiselevel
-            nthres = -1 * noiselevel
-            if peak_sign == 1:
-                nthres = None
-            elif peak_sign == -1:
-                pthres = None
-            # https://nmrglue.readthedocs.io/en/latest/reference/generated/nmrglue.analysis.peakpick.pick.html
-            # msep = 
-            grid_peaks = ng.analysis.peakpick.pick(data, pthres=pthres, nthres=nthres, algorithm='connected')
-        except ImportError:
-            print_log('Importing NMRGLUE failed. Using UCSFtool instead.')
-
-    if args.number:
-        peak_count = min(peak_count, len(grid_peaks))
+    if args.ress:
+        res = list(map(lambda x: int(args.ress[x]), range(len(args.ress))))
     else:
-        peak_count = len(grid_peaks)
-    print_log('Detected peak count: ' + str(len(grid_peaks)))
-
-    # interpolation and get adjusted data heights
-    print_log('Using UCSFTOOL to interpolate and obtain adjusted heights.')
-    peak_list, hts_list = [], []
-    
-    for grid_peak in grid_peaks:
-        grid_pt = ()
-        for i in range(ndim):
-            grid_pt += (int(grid_peak[i]),)
-            
-    #for i in range(len(grid_peaks)):
-        #grid_peak = grid_peaks[i]
-        #grid_peak, grid_ht = grid_peaks[i], grid_hts[i]
-        #print(grid_ht)
-        #print(grid_peak)
-        #grid_pt = ()
-        #for i in range(ndim):
-        #    grid_pt += (int(grid_peak[i]),)
-        #shifts, value = ut.get_interpolated_data(grid_pt)
-        #shifts = ut.grids_to_shifts(grid_peak)
-        #value = grid_ht
-        #shifts, value = ut.get_interpolated_data(grid_peak, noise_level = noiselevel)
-        
-        shifts, value = ut.get_interpolated_data(grid_pt, noise_level = noiselevel)
-        if shifts == None:
-            continue
-        peak_list.append(shifts)
-        hts_list.append(value)
-
-    # sort by adjusted heights
-    print_log('Using UCSFTOOL to sort and filter peaks.')
-    sort_peaks, sort_hts = ut.filter_peaks_by_count(peak_list,
-                                                    hts_list,
-                                                    peak_count)
+        res = [args.res] * ndim
+    memory_limit = None
+    if args.stream_memory:
+        memory_limit = args.stream_memory * 1024**2
+    print_event('stage', stage='pick')
+    sort_peaks, sort_hts = pick_peaks(ut, noiselevel, res, peak_sign,
+                                      peak_count, args.software, args.engine,
+                                      memory_limit, args.local_noise)
 
     if len(sort_peaks) == 0:
         print_log('No peak detected.')
+        print_event('done', peaks=0, output=None)
         return
 
+    print_event('stage', stage='write')
     print_log('Using UCSFTOOL to write a SPARKY peak list.')
     ut.write_sparky_peaks(out_filename, sort_peaks, sort_hts)
-    print_log('%d peaks written in %s' % (peak_count, out_filename))
+    print_log('%d peaks written in %s' % (len(sort_peaks), out_filename))
     ut.ucsf_close()
+    print_event('done', peaks=len(sort_peaks), output=out_filename)
 
     # this is to be checked by other modules that this program is done
     time.sleep(0.5)
-    IPICK_PATH = os.path.abspath(os.path.dirname(__file__))
-    done_file = open(os.path.join(tempfile.gettempdir(), 'done'), 'w')
+    done_file = open(DONE_FILE, 'w')
     done_file.close()
 
 
 if __name__ == '__main__':
+    # child processes of frozen executables start here
+    multiprocessing.freeze_support()
     main()
@@ -18,13 +18,18 @@ import time
 import sys
 import tempfile
 import multiprocessing
+import itertools
+import threading
+import shutil
 
 if sys.version_info[0] == 2:
+  import Queue as queue
   import Tkinter as tk
   #from ttk import Combobox
   import tkMessageBox
   import tkFont
 else:
+  import queue
   import tkinter as tk
   from tkinter.ttk import Combobox
   import tkinter.messagebox as tkMessageBox
@@ -63,8 +68,12 @@ else:   # poky
 
 
 IPICK_PATH = os.path.abspath(os.path.dirname(__file__))
-LOG_FILE = os.path.join(tempfile.gettempdir(), 'process.log')   # '/tmp/process.log' for Linux/Mac
-DONE_FILE = os.path.join(tempfile.gettempdir(), 'done')
+OUTPUT_INTERVAL = 100       # milliseconds between reads of the iPick output
+JOB_LIMIT = 12              # spectra picked at the same time by run_ipick_multi()
+
+IMPORT_WARN_COUNT = 50000   # ask before importing more peaks than this
+IMPORT_CHUNK = 500          # peaks placed between status updates
+STATUS_INTERVAL = 0.25      # seconds between status updates
 
 sys.path.append(IPICK_PATH)
 try:
@@ -78,32 +87,61 @@ if ((sys.platform == 'win32') or (sys.platform == 'cygwin')):
 
 manual_coeff, coeff1, coeff2, coeff3, SNR_abs, volume_abs = [[]] * 6
 
-class ipick_dialog(tkutil.Dialog, tkutil.Stoppable):
-  def __init__(self, session):
+# ---------------------------------------------------------------------------
+# Reads the lines of an output stream into a queue until it is closed.
+# None is put at the end.
+def read_output(stream, output_queue):
+    for line in iter(stream.readline, ''):
+        output_queue.put(line)
+    stream.close()
+    output_queue.put(None)
 
-    #print(os.getcwd())
 
-    # prepare temp files
-    if os.path.exists(LOG_FILE):
-        os.remove(LOG_FILE)
+# ---------------------------------------------------------------------------
+# One run of iPick for a spectrum. Each job has its own directory for the
+# log, status and done files of iPick and its own peak list (see
+# find_peaklist_file()), so jobs do not share any file.
+class ipick_job:
+  def __init__(self, spectrum, peaklist_file, callback=None, nproc=1,
+               mem_limit=None):
+    self.spectrum = spectrum
+    self.peaklist_file = peaklist_file
+    self.callback = callback        # called when the job is finished
+    self.nproc = nproc              # cores used by the job
+    self.mem_limit = mem_limit      # MB for the spectrum cache of iPick
+    self.stage = None               # last stage of iPick
+    self.job_dir = tempfile.mkdtemp(prefix='ipick-')
+    self.proc = None
+    self.output_queue = queue.Queue()
+    self.result = None              # the 'done' or 'error' event of iPick
+    self.stopped = False
+
 
-    if os.path.exists(DONE_FILE):
-        os.remove(DONE_FILE)
+class ipick_dialog(tkutil.Dialog, tkutil.Stoppable):
+  def __init__(self, session):
 
-    open(LOG_FILE, 'w').write('')
+    #print(os.getcwd())
 
 
     self.session = session
     self.basic_adv = 'basic'
-    self.stopped_flag = 0
+    self.jobs = []      # running ipick_job objects
+    self.job_queue = []     # spectra waiting for run_ipick_multi()
+    self.job_count = 0      # spectra of the current run_ipick_multi()
+    self.jobs_done = 0
+    self.job_mem_limit = None   # MB for each job of run_ipick_multi()
+    self.import_queue = []  # finished jobs waiting for their peaks imported
+    self.importing = False
     # these will be updated later:
     self.resolution = '1'
     self.import_dist = 0.0
     self.import_drop = 0.0
+    self.import_verbose = False     # print every close peak comparison
     self.auto_integration = True
     self.spectrum = None
     self.previous_spectrum = None
     self.last_PEAKLIST_FILE = None
+    self.peaklist_files = {}    # last peak list of each data file by iPick
     self.spectrum_list_selection = None
 
 
@@ -556,20 +594,18 @@ class ipick_dialog(tkutil.Dialog, tkutil.Stoppable):
   def stop_button(self, *args):
     try:
 
-        if not OS_WINDOWS:
-            os.killpg(os.getpgid(self.proc.pid), signal.SIGKILL)
+        self.job_queue = []
+        for job in self.jobs:
+            job.stopped = True
+            if not OS_WINDOWS:
+                os.killpg(os.getpgid(job.proc.pid), signal.SIGKILL)
 
     #    import psutil
-    #    process = psutil.Process(self.proc.pid)
+    #    process = psutil.Process(job.proc.pid)
     #    for proc in process.children(recursive=True):
     #        proc.kill()
     #    process.kill()
 
-        done_file = open(DONE_FILE, 'w')
-        done_file.close()
-
-        time.sleep(0.5)
-
         if (self.basic_adv == 'basic'):
             output = self.b_output
             status = self.b_status
@@ -583,8 +619,6 @@ class ipick_dialog(tkutil.Dialog, tkutil.Stoppable):
         status.config(text="Status: Process Stopped!")
         status.update()
 
-        self.stopped_flag = 1
-
 
         self.stop_cb()
         self.a_stop_button['state'] = 'disabled'
@@ -627,20 +661,25 @@ class ipick_dialog(tkutil.Dialog, tkutil.Stoppable):
       if self.spectrum == None:
         tkMessageBox.showwarning(title='Error', message='You need to select a spectrum first!')
         return
+      self.spectrum_peak_list(self.spectrum)
+
+
+# ---------------------------------------------------------------------------
+  def spectrum_peak_list(self, spectrum):
       try:
         getattr(self.session, 'spectrum_dialogs')
       except:
         self.session.spectrum_dialogs = {}
       dialogs = self.session.spectrum_dialogs
-      if (self.spectrum in dialogs and \
-          not dialogs[self.spectrum].is_window_destroyed()):
-        dialogs[self.spectrum].show_window(1)
+      if (spectrum in dialogs and \
+          not dialogs[spectrum].is_window_destroyed()):
+        dialogs[spectrum].show_window(1)
       else:
         d = peak_list_dialog.peak_list_dialog(self.session)
         d.show_window(1)
         d.settings.show_fields('Assignment', 'Chemical Shift', 'Reliability Score')
-        d.show_spectrum_peaks(self.spectrum)
-        dialogs[self.spectrum] = d
+        d.show_spectrum_peaks(spectrum)
+        dialogs[spectrum] = d
         d.sort_reliability()
 
 
@@ -831,9 +870,9 @@ class ipick_dialog(tkutil.Dialog, tkutil.Stoppable):
 
 
 # ---------------------------------------------------------------------------
-  def ipick_process(self, UCSF_FILE):
+  def ipick_process(self, job, UCSF_FILE):
 
-    CPUs = str(multiprocessing.cpu_count())
+    CPUs = str(job.nproc)
     if OS_WINDOWS:
         CPUs = '1'
 
@@ -844,7 +883,7 @@ class ipick_dialog(tkutil.Dialog, tkutil.Stoppable):
 
     cmd = (PYTHON_BIN + " " + os.path.join(IPICK_PATH, "iPick.py") +
             " -i " + "\"" + UCSF_FILE + "\"" +
-            " -o " + "\"" + self.PEAKLIST_FILE + "\"" +
+            " -o " + "\"" + job.peaklist_file + "\"" +
             " -r " + self.resolution +
             " -c " + CPUs +
             " -s " + ucsftool_nmrglue +
@@ -856,7 +895,7 @@ class ipick_dialog(tkutil.Dialog, tkutil.Stoppable):
         # using noise level
         cmd = (PYTHON_BIN + " " + os.path.join(IPICK_PATH, "iPick.py") +
                 " -i " + "\"" + UCSF_FILE + "\"" +
-                " -o " + "\"" + self.PEAKLIST_FILE + "\"" +
+                " -o " + "\"" + job.peaklist_file + "\"" +
                 " -r " + self.resolution +
                 " -c " + CPUs +
                 " -s " + ucsftool_nmrglue +
@@ -869,7 +908,7 @@ class ipick_dialog(tkutil.Dialog, tkutil.Stoppable):
         # using contour level
         cmd = (PYTHON_BIN + " " + os.path.join(IPICK_PATH, "iPick.py") +
                " -i " + "\"" + UCSF_FILE + "\"" +
-               " -o " + "\"" + self.PEAKLIST_FILE + "\"" +
+               " -o " + "\"" + job.peaklist_file + "\"" +
                " -r " + self.resolution +
                " -c " + CPUs +
                " -s " + ucsftool_nmrglue +
@@ -877,12 +916,25 @@ class ipick_dialog(tkutil.Dialog, tkutil.Stoppable):
                " --threshold " + self.a_contour.variable.get() +
                " --overwrite")
 
+    cmd += " --job-dir " + "\"" + job.job_dir + "\""
+    if job.mem_limit:
+        cmd += " --mem-limit " + str(job.mem_limit)
+
     print(cmd)
 
+    # the output of iPick is read line by line in a thread (see read_output())
+    env = dict(os.environ)
+    env['PYTHONUNBUFFERED'] = '1'
     if OS_WINDOWS:
-        self.proc = subprocess.Popen(cmd, shell=True, stdin=None, stdout=None, stderr=None, close_fds=True)
+        job.proc = subprocess.Popen(cmd, shell=True, stdin=None, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                    universal_newlines=True, env=env)
     else:
-        self.proc = subprocess.Popen(cmd, shell=True, stdin=None, stdout=None, stderr=None, close_fds=True, preexec_fn=os.setsid)
+        job.proc = subprocess.Popen(cmd, shell=True, stdin=None, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                    universal_newlines=True, env=env, close_fds=True, preexec_fn=os.setsid)
+
+    reader = threading.Thread(target=read_output, args=(job.proc.stdout, job.output_queue))
+    reader.daemon = True
+    reader.start()
 
 
 # ---------------------------------------------------------------------------
@@ -893,21 +945,61 @@ class ipick_dialog(tkutil.Dialog, tkutil.Stoppable):
         tkMessageBox.showwarning(title='Error', message='No spectrum was selected!')
         return
 
-    for spec_id in self.b_tree.selected_line_numbers():
-        self.spectrum = self.spec_list[spec_id]
-        views = self.session.project.view_list()
-        for v in views:
-            if v.name == self.spectrum.name:
-                v.got_focus()
-                self.pos_contour = v.positive_levels.lowest
-                self.neg_contour = v.negative_levels.lowest
-                break
-        self.contour_level()
-        self.run_ipick()
+    # Up to JOB_LIMIT spectra (one per core) are picked at the same time.
+    # When a job finishes, the next spectrum is started with the cores that
+    # are not used by the running jobs (see run_next_job()).
+    self.job_queue = list(self.b_tree.selected_line_numbers())
+    self.job_count = len(self.job_queue)
+    self.jobs_done = 0
+    job_slots = max(1, min(self.job_count, multiprocessing.cpu_count(), JOB_LIMIT))
+
+    # the memory of the spectrum caches is shared by the jobs as well
+    self.job_mem_limit = None
+    if hasattr(iPick.ucsftool, 'get_memory_budget'):
+        budget = iPick.ucsftool.get_memory_budget()
+        if budget:
+            self.job_mem_limit = max(1, budget // job_slots // 1024**2)
+
+    if (self.basic_adv == 'basic'):
+        output = self.b_output
+    else:
+        output = self.a_output
+    output.delete('1.0', tk.END)
+
+    for i in range(job_slots):
+        self.run_next_job()
 
 
 # ---------------------------------------------------------------------------
-  def run_ipick(self):
+  def run_next_job(self):
+    if len(self.job_queue) == 0:
+        if len(self.jobs) == 0:
+            self.job_count = 0      # run_ipick_multi() is over
+        return
+
+    # cores of the running jobs are not shared
+    free_cores = multiprocessing.cpu_count() - sum(job.nproc for job in self.jobs)
+    new_jobs = min(len(self.job_queue), max(1, JOB_LIMIT - len(self.jobs)))
+    nproc = max(1, free_cores // new_jobs)
+
+    self.spectrum = self.spec_list[self.job_queue.pop(0)]
+    views = self.session.project.view_list()
+    for v in views:
+        if v.name == self.spectrum.name:
+            v.got_focus()
+            self.pos_contour = v.positive_levels.lowest
+            self.neg_contour = v.negative_levels.lowest
+            break
+    self.contour_level()
+    self.run_ipick(self.run_next_job, nproc, self.job_mem_limit)
+
+
+# ---------------------------------------------------------------------------
+  def run_ipick(self, callback=None, nproc=None, mem_limit=None):
+    # Starts an iPick job and returns. The output is read by
+    # read_ipick_output() and ipick_finished() calls callback when the job
+    # is done (or right away if the job is not started).
+    # nproc is all the cores by default.
 
     if (self.basic_adv == 'basic'):
         widget = self.b_status
@@ -918,6 +1010,9 @@ class ipick_dialog(tkutil.Dialog, tkutil.Stoppable):
 
     if self.spectrum == None:
         tkMessageBox.showwarning(title='Error', message='You need to select a spectrum first!')
+        self.jobs_done += 1
+        if callback:
+            callback()
         return
 
     if self.previous_spectrum == self.spectrum:
@@ -925,6 +1020,9 @@ class ipick_dialog(tkutil.Dialog, tkutil.Stoppable):
              message='You have already run iPick for this experiment. Do you want to run it again?')
 
         if confirmation == False:
+            self.jobs_done += 1
+            if callback:
+                callback()
             return
 
     self.set_resolution()
@@ -941,99 +1039,205 @@ class ipick_dialog(tkutil.Dialog, tkutil.Stoppable):
 
     UCSF_FILE = self.spectrum.data_path
 
+    # the output of run_ipick_multi() is cleared once when it starts
+    if len(self.jobs) == 0 and self.job_count < 2:
+        if (self.basic_adv == 'basic'):
+            output = self.b_output
+        else:
+            output = self.a_output
+        output.delete('1.0', tk.END)
 
-    try:
+    if nproc == None:
+        nproc = multiprocessing.cpu_count()
+    job = ipick_job(self.spectrum, None, callback, nproc, mem_limit)
+    self.find_peaklist_file(os.path.basename(job.job_dir))
+    job.peaklist_file = self.PEAKLIST_FILE
+    self.peaklist_files[UCSF_FILE] = job.peaklist_file
+
+    if os.path.exists(job.peaklist_file):
+        os.remove(job.peaklist_file)
 
-        self.find_peaklist_file()
+    self.ipick_process(job, UCSF_FILE)
+    self.jobs.append(job)
+    self.b_stop_button['state'] = 'normal'
+    self.a_stop_button['state'] = 'normal'
 
-        if os.path.exists(self.PEAKLIST_FILE):
-            os.remove(self.PEAKLIST_FILE)
+    if self.job_count > 1:
+        self.show_jobs_status()
 
-        #self.ipick_process(UCSF_FILE)
-        self.stoppable_call(self.ipick_process, UCSF_FILE)
-        self.b_stop_button['state'] = 'normal'
-        self.a_stop_button['state'] = 'normal'
+    self.top.after(OUTPUT_INTERVAL, self.read_ipick_output, job)
 
 
+# ---------------------------------------------------------------------------
+  def read_ipick_output(self, job):
+    # Appends the new lines of the iPick output and handles its events.
+    # Scheduled by Tk every OUTPUT_INTERVAL until the output is closed.
+    finished = False
+    lines = []
+    try:
         while True:
-            log = open(LOG_FILE, 'r')
+            line = job.output_queue.get_nowait()
+            if line is None:
+                finished = True
+                break
+            lines.append(line)
+    except queue.Empty:
+        pass
 
+    text = ''
+    for line in lines:
+        event = iPick.parse_event(line)
+        if event is None:
+            text += line
+        else:
+            self.ipick_event(job, event)
 
-            if (self.basic_adv == 'basic'):
-                widget = self.b_output
-            else:
-                widget = self.a_output
+    if text and not job.stopped:
+        self.append_output(job, text)
 
+    if finished:
+        job.proc.wait()
+        self.ipick_finished(job)
+    else:
+        self.top.after(OUTPUT_INTERVAL, self.read_ipick_output, job)
 
-            widget.delete('1.0', tk.END)
-            widget.insert(tk.END, log.read())
-            widget.see(tk.END)
-            widget.update()
 
-            log.close()
+# ---------------------------------------------------------------------------
+  def append_output(self, job, text):
+    # lines of concurrent jobs are marked by the spectrum names
+    if self.job_count > 1:
+        lines = text.splitlines(True)
+        text = ''.join('[' + job.spectrum.name + '] ' + line for line in lines)
 
-            time.sleep(0.5)
+    if (self.basic_adv == 'basic'):
+        output = self.b_output
+    else:
+        output = self.a_output
+    output.insert(tk.END, text)
+    output.see(tk.END)
 
-            if os.path.exists(DONE_FILE):
-                try:
-                    os.remove(DONE_FILE)
-                except:
-                    tkMessageBox.showwarning(title='Error', message='Could not delete "done" file')
 
-                break
+# ---------------------------------------------------------------------------
+  def ipick_event(self, job, event):
+    if (self.basic_adv == 'basic'):
+        widget = self.b_status
+    else:
+        widget = self.a_status
+
+    if event['event'] == 'stage':
+        job.stage = event['stage']
+        if self.job_count > 1:
+            self.show_jobs_status()
+        else:
+            stages = {'noise': 'finding the noise level',
+                      'pick': 'picking the peaks',
+                      'write': 'writing the peak list'}
+            widget.config(text="Status: iPick is " + stages.get(event['stage'], 'running') + " ...")
+
+    elif event['event'] in ('done', 'error'):
+        job.result = event
+        if event['event'] == 'error':
+            if self.job_count > 1:
+                self.append_output(job, event['message'] + '\n')
+            else:
+                widget.config(text="Status: " + event['message'])
 
 
-    except TypeError as e:
+# ---------------------------------------------------------------------------
+  def show_jobs_status(self):
+    # progress of run_ipick_multi(): finished spectra and the running jobs
+    if (self.basic_adv == 'basic'):
+        widget = self.b_status
+    else:
+        widget = self.a_status
 
-        if (self.basic_adv == 'basic'):
-            widget = self.b_status
-        else:
-            widget = self.a_status
+    stages = {'noise': 'noise level', 'pick': 'picking', 'write': 'writing'}
+    running = []
+    for job in self.jobs:
+        running.append(job.spectrum.name + ': ' + stages.get(job.stage, 'starting'))
+
+    text = "Status: %d of %d spectra done" % (self.jobs_done, self.job_count)
+    if running:
+        text += " (" + ", ".join(running) + ")"
+    widget.config(text=text)
+
+
+# ---------------------------------------------------------------------------
+  def ipick_finished(self, job):
 
-        widget.config(text="Status: Peak list file is corrupted.")
-        widget.update()
-        print(e)
-        print(sys.exc_type)
+    self.jobs.remove(job)
+    self.jobs_done += 1
 
+    if (self.basic_adv == 'basic'):
+        widget = self.b_status
     else:
-#        log = open(LOG_FILE, 'r')
-#
-#        if (self.basic_adv == 'basic'):
-#            widget = self.b_output
-#        else:
-#            widget = self.a_output
-#
-#
-#        widget.delete('1.0', tk.END)
-#        widget.insert(tk.END, log.read())
-#        widget.see(tk.END)
-#        widget.update()
-#
-#        log.close()
-
-        if self.stopped_flag == 0:
-
-            if (self.basic_adv == 'basic'):
-                widget = self.b_status
+        widget = self.a_status
+
+    message = None
+    import_peaks = False
+    if not job.stopped:
+        if job.result == None:
+            message = "iPick failed. See the output."
+            print('The iPick log is kept in "' + job.job_dir + '".')
+
+        elif job.result['event'] == 'done':
+            if job.result['peaks'] == 0:
+                message = "No peak detected."
             else:
-                widget = self.a_status
-            widget.config(text="Status: Peak picking is done.")
-            widget.update()
+                message = "Peak picking is done."
+
+                print('Found peaks are also stored in "' + job.peaklist_file + '" file.')
 
-            print('Found peaks are also stored in "' + self.PEAKLIST_FILE + '" file.')
+                #tkMessageBox.showinfo(title='Job Done!', message='Peak picking is finished!')
 
-            #tkMessageBox.showinfo(title='Job Done!', message='Peak picking is finished!')
 
+                if ((self.basic_adv == 'basic') and self.b_check_import.get()) or \
+                   ((self.basic_adv == 'adv') and self.a_check_import.get()):
+                        import_peaks = True
 
-            if ((self.basic_adv == 'basic') and self.b_check_import.get()) or \
-               ((self.basic_adv == 'adv') and self.a_check_import.get()):
-                    self.stoppable_call(self.place_peaks)
+    # the job directory is kept only when iPick failed
+    if job.stopped or (job.result != None and job.result['event'] == 'done'):
+        shutil.rmtree(job.job_dir, ignore_errors=True)
 
-    self.stopped_flag = 0
-    self.a_stop_button['state'] = 'disabled'
-    self.b_stop_button['state'] = 'disabled'
+    if len(self.jobs) == 0 and len(self.job_queue) == 0:
+        self.a_stop_button['state'] = 'disabled'
+        self.b_stop_button['state'] = 'disabled'
 
-    self.previous_spectrum = self.spectrum
+    self.previous_spectrum = job.spectrum
+
+    if message:
+        if self.job_count > 1:
+            self.append_output(job, message + '\n')
+            self.show_jobs_status()
+        else:
+            widget.config(text="Status: " + message)
+            widget.update()
+
+    # the next job is started before the peaks of this one are imported
+    if job.callback:
+        job.callback()
+
+    if import_peaks:
+        self.import_queue.append(job)
+        self.import_jobs()
+
+    if len(self.jobs) == 0 and len(self.job_queue) == 0:
+        self.job_count = 0      # run_ipick_multi() is over
+
+
+# ---------------------------------------------------------------------------
+  def import_jobs(self):
+    # Imports the peaks of the finished jobs one by one. Jobs finishing
+    # during an import (Tk keeps running) wait in import_queue.
+    if self.importing:
+        return
+    self.importing = True
+    while len(self.import_queue) > 0:
+        job = self.import_queue.pop(0)
+        self.stoppable_call(self.place_peaks, job.spectrum, job.peaklist_file)
+    self.importing = False
+    if self.job_count > 1:
+        self.show_jobs_status()
 
 
 # ---------------------------------------------------------------------------
@@ -1053,7 +1257,54 @@ class ipick_dialog(tkutil.Dialog, tkutil.Stoppable):
 
 
 # ---------------------------------------------------------------------------
-  def find_peaklist_file(self):
+  def data_heights(self, spectrum, points):
+    # Heights of many spectrum positions, read directly from the UCSF file.
+    # Falls back to data_height() of Sparky for each point.
+    if len(points) == 0:
+        return []
+    tool = iPick.ucsftool.ucsfTool()
+    if hasattr(tool, 'get_linear_data_by_shifts'):
+        if tool.ucsf_open(spectrum.data_path, cache_mode='lazy') != 0:
+            if tool.ndim == len(points[0]):
+                offset = spectrum.scale_offset
+                shifts = [tuple(map(lambda i, j: i - j, pt, offset)) for pt in points]
+                heights = tool.get_linear_data_by_shifts(shifts)
+                tool.ucsf_close()
+                if heights is not None:
+                    return heights
+            else:
+                tool.ucsf_close()
+    return [spectrum.data_height(pt) for pt in points]
+
+
+# ---------------------------------------------------------------------------
+  def peak_grid(self, peaks, cell_size):
+    # uniform grid hash of the peaks: cell of the frequencies -> [(index, peak)]
+    grid = {}
+    for i in range(len(peaks)):
+        cell = tuple(int(x // cell_size) for x in peaks[i].frequency)
+        grid.setdefault(cell, []).append((i, peaks[i]))
+    return grid
+
+
+# ---------------------------------------------------------------------------
+  def near_peaks(self, grid, freq, dist):
+    # peaks closer than dist to freq in the grid of cell size dist (in order)
+    cell = tuple(int(x // dist) for x in freq)
+    near = []
+    for offset in itertools.product((-1, 0, 1), repeat=len(cell)):
+        key = tuple(cell[i] + offset[i] for i in range(len(cell)))
+        for i, p in grid.get(key, ()):
+            if self.distance(p.frequency, freq) < dist:
+                near.append((i, p))
+    near.sort(key=lambda x: x[0])
+    return [p for i, p in near]
+
+
+# ---------------------------------------------------------------------------
+  def find_peaklist_file(self, job_id=None):
+    # The temporary directory is shared by all the runs, so the peak list
+    # of a job there has the job id in its name.
 
     UCSF_FILE = self.spectrum.data_path
 
@@ -1061,7 +1312,11 @@ class ipick_dialog(tkutil.Dialog, tkutil.Stoppable):
     experiment_name = os.path.splitext(experiment_file)[0]
     peak_list = experiment_name + '.list'
 
-    self.PEAKLIST_FILE = os.path.join(tempfile.gettempdir(), peak_list)
+    if job_id:
+        self.PEAKLIST_FILE = os.path.join(tempfile.gettempdir(),
+                                          experiment_name + '-' + job_id + '.list')
+    else:
+        self.PEAKLIST_FILE = os.path.join(tempfile.gettempdir(), peak_list)
 
     # try putting the peak list file in the Lists folder
     try:
@@ -1076,7 +1331,9 @@ class ipick_dialog(tkutil.Dialog, tkutil.Stoppable):
 
 
 # ---------------------------------------------------------------------------
-  def place_peaks(self):
+  def place_peaks(self, spectrum=None, peaklist_file=None):
+    # Imports the peaks of peaklist_file to spectrum. By default, the peak
+    # list of iPick for the selected spectrum.
     if (self.basic_adv == 'basic'):
         status = self.b_status
     else:
@@ -1084,46 +1341,56 @@ class ipick_dialog(tkutil.Dialog, tkutil.Stoppable):
     status.config(text="Status: Importing the peaks (0%)")
     status.update()
 
-    self.find_peaklist_file()
+    if spectrum == None:
+        spectrum = self.spectrum
+
+    if peaklist_file == None:
+        try:
+            peaklist_file = self.peaklist_files.get(spectrum.data_path)
+            if peaklist_file == None:
+                self.find_peaklist_file()
+                peaklist_file = self.PEAKLIST_FILE
+        except:
+            pass
 
     try:
-        print("Importing the peaks from: " + self.PEAKLIST_FILE)
+        print("Importing the peaks from: " + peaklist_file)
     except:
         tkMessageBox.showwarning(title='Error', message='You need to run iPick first!')
         return
 
-    if self.last_PEAKLIST_FILE == self.PEAKLIST_FILE:
+    if self.last_PEAKLIST_FILE == peaklist_file:
         confirmation = tkMessageBox.askokcancel(title='Continue?',
              message='You have already imported these peaks. Do you want to import them again?')
         if confirmation == False:
-            self.show_peak_list()
+            self.spectrum_peak_list(spectrum)
             return
 
-    peaks = open(self.PEAKLIST_FILE, 'r').readlines()
+    peaks = open(peaklist_file, 'r').readlines()
     if len(peaks) < 4:
         tkMessageBox.showwarning(title='Error', message='Peak list file is empty!')
         return
 
 
-    if len(peaks) > 5000:
+    if len(peaks) > IMPORT_WARN_COUNT:
         confirmation = tkMessageBox.askokcancel(title='Continue?',
              message='iPick will try to import ' + str(len(peaks)) + ' peaks. This can take a long time. Do you want to continue?')
         if confirmation == False:
-            self.show_peak_list()
+            self.spectrum_peak_list(spectrum)
             return
 
-    if self.spectrum == None:
+    if spectrum == None:
         tkMessageBox.showwarning(title='Error', message='You need to select a spectrum first!')
         return
 
     #spec = s.selected_spectrum()
-    view = self.get_view(self.spectrum)
+    view = self.get_view(spectrum)
 
     self.set_import_dist()
     self.set_import_drop()
     self.integration_check()
 
-    spec_peaks = self.spectrum.peak_list()
+    spec_peaks = spectrum.peak_list()
     #print spec_peaks[1].frequency[0]
 
     print('\n\nCurrent peaks in the spectra: ' + str(len(spec_peaks)))
@@ -1136,95 +1403,115 @@ class ipick_dialog(tkutil.Dialog, tkutil.Stoppable):
 
 
 # Check if the new peak already exist on the spectrum
+    # Existing peaks are hashed in a grid of import_dist cells, so only the
+    # peaks in the neighbor cells are compared.
+    if self.import_dist > 0:
+        peak_grid = self.peak_grid(spec_peaks, self.import_dist)
+    else:
+        peak_grid = {}
 
-    #TODO: make this comparison faster
-
-    placed_peaks = 0
-
+    new_peaks = []
     for i in range(2, len(peaks)):
-        self.top.update()
         new_peak_list = peaks[i].split()[1:-1]   # also removes the first and last columns from the peak list file
         new_peak_tuple = tuple(float(e) for e in new_peak_list)
-        new_peak = tuple(map(lambda i, j: i + j, new_peak_tuple, self.spectrum.scale_offset))
-
-        new_peak_flag = True
-
-        if spec_peaks == []:
-            pk = self.spectrum.place_peak(new_peak)
-            placed_peaks += 1
-            if self.auto_integration:
-                pk.fit(view)
-            continue
-
-        print('\nNew peak #' + str(i-1) + ' from ' + str(len(peaks)-2))
-        percent = "{:2.0f}".format(100 * (i-1) / len(peaks)-2)
-        status.config(text="Status: Importing the peaks (" + percent + "%)")
-        status.update()
-
-        k = 1
-        for exis_peak in spec_peaks:
-            print('Comparing with peak #' + str(k) + ' from ' + str(len(spec_peaks)))
-            k += 1
-
-            #print exis_peak.frequency[0]
-            #print new_peak[0]
-            #print self.import_dist
-            #print self.distance(exis_peak.frequency, new_peak)
-
-            # this is a pre-condition to make the loop faster
-            if ((exis_peak.frequency[0] - new_peak[0]) < self.import_dist * 2):
-
-                if (self.distance(exis_peak.frequency, new_peak) < self.import_dist):
+        new_peaks.append(tuple(map(lambda i, j: i + j, new_peak_tuple, spectrum.scale_offset)))
+
+    # Close pairs are collected first and the heights of all the peaks and
+    # midpoints are evaluated at once, instead of three data_height() calls
+    # per pair.
+    near_list = []
+    for new_peak in new_peaks:
+        if peak_grid:
+            near_list.append(self.near_peaks(peak_grid, new_peak, self.import_dist))
+        else:
+            near_list.append([])
+
+    points = []
+    for new_peak, near_peaks in zip(new_peaks, near_list):
+        if near_peaks:
+            points.append(new_peak)
+        for exis_peak in near_peaks:
+            points.append(exis_peak.frequency)
+            points.append(self.mid_point(exis_peak.frequency, new_peak))
+    heights = dict(zip(points, self.data_heights(spectrum, points)))
+
+    # The peaks are placed in chunks and the status is updated at most every
+    # STATUS_INTERVAL seconds. Fitting is done at the end for all the placed
+    # peaks, so Tk is not redrawn for every single peak.
+    placed_peaks = []
+    last_update = time.time()
+
+    for start in range(0, len(new_peaks), IMPORT_CHUNK):
+        for i in range(start, min(start + IMPORT_CHUNK, len(new_peaks))):
+            new_peak = new_peaks[i]
+
+            new_peak_flag = True
+
+            if self.import_verbose and spec_peaks != []:
+                print('\nNew peak #' + str(i+1) + ' from ' + str(len(new_peaks)))
+
+            for exis_peak in near_list[i]:
+                if self.import_verbose:
                     print('The new peak is too close to this already existing peak:')
                     print(exis_peak.frequency)
 
-                    #print self.spectrum.data_height((117.6,5.2,8.13))
-                    midpoint_height = self.spectrum.data_height(self.mid_point(exis_peak.frequency, new_peak))
-
-                    new_peak_height = self.spectrum.data_height(new_peak)
-                    exis_peak_height = self.spectrum.data_height(exis_peak.frequency)
+                midpoint_height = heights[self.mid_point(exis_peak.frequency, new_peak)]
 
-                    #print new_peak_height
-                    #print exis_peak_height
-                    #print midpoint_height
+                new_peak_height = heights[new_peak]
+                exis_peak_height = heights[exis_peak.frequency]
 
-                    if (((new_peak_height - midpoint_height) < self.import_drop) or \
-                       ((exis_peak_height - midpoint_height) < self.import_drop)):
+                if (((new_peak_height - midpoint_height) < self.import_drop) or \
+                   ((exis_peak_height - midpoint_height) < self.import_drop)):
+                        if self.import_verbose:
                             print('No drop between the peaks. Skipping importing this peak.')
-                            new_peak_flag = False
-                            break
-
-
-        if new_peak_flag:
-            print('This is a new peak. Importing this peak.')
-            pk = self.spectrum.place_peak(new_peak)
-            placed_peaks += 1
-
-            if self.auto_integration:
-                if self.integration_radio.get() == '1':
-                    pk.fit(view)
-#                else:
-#                    pk.selected = 1
-#                    self.session.command_characters("pi")
+                        new_peak_flag = False
+                        break
+
+            if new_peak_flag:
+                if self.import_verbose and spec_peaks != []:
+                    print('This is a new peak. Importing this peak.')
+                placed_peaks.append(spectrum.place_peak(new_peak))
+
+        if time.time() - last_update > STATUS_INTERVAL:
+            percent = "{:2.0f}".format(100.0 * (i+1) / len(new_peaks))
+            status.config(text="Status: Importing the peaks (" + percent + "%)")
+            status.update()
+            self.top.update()
+            last_update = time.time()
+
+    if self.auto_integration:
+        if self.integration_radio.get() == '1':
+            status.config(text="Status: Fitting the peaks")
+            status.update()
+            for i in range(len(placed_peaks)):
+                placed_peaks[i].fit(view)
+                if time.time() - last_update > STATUS_INTERVAL:
+                    percent = "{:2.0f}".format(100.0 * (i+1) / len(placed_peaks))
+                    status.config(text="Status: Fitting the peaks (" + percent + "%)")
+                    status.update()
+                    self.top.update()
+                    last_update = time.time()
 
     if self.integration_radio.get() == '2':
-        for p in self.spectrum.peak_list():
+        if view != None:
+            view.got_focus()    # "pi" fits the peaks of the focused view
+        for p in spectrum.peak_list():
             p.selected = 1
         self.session.command_characters("pi")
-        for p in self.spectrum.peak_list():
+        for p in spectrum.peak_list():
             p.selected = 0
 
     status.config(text="Status: Importing the peaks is completed.")
     status.update()
 
-    print('\nImport Completed! ' + str(placed_peaks) + ' new peaks are placed on the spectrum.')
+    print('\nImport Completed! ' + str(len(placed_peaks)) + ' new peaks are placed on the spectrum.')
     #tkMessageBox.showinfo(title='Import Completed!', message=str(placed_peaks) + ' peaks are placed on the spectrum.')
 
     #self.session.command_characters('lt')
     time.sleep(0.3)     # a delay is needed for the peak list to update
-    self.show_peak_list()    # show _our_ peak list instead of the default one
+    self.spectrum_peak_list(spectrum)    # show _our_ peak list instead of the default one
 
-    self.last_PEAKLIST_FILE = self.PEAKLIST_FILE
+    self.last_PEAKLIST_FILE = peaklist_file
 
 
 
@@ -0,0 +1,69 @@
+"""Local noise levels keep weak peaks in quiet regions (requires numpy)"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+np = pytest.importorskip('numpy')
+
+import iPick
+import ucsftool3
+
+
+SHAPE = (64, 64)
+TILE_SIZE = (16, 16)
+PEAK = (24, 24)     # center of tile (1, 1), the quiet tile
+NOISE_LEVEL = 5e4   # global threshold, above the weak peak
+
+
+def write_spectrum(path):
+    rnd = np.random.RandomState(0)
+    data = rnd.normal(0, 1e4, SHAPE)
+    data[16:32, 16:32] = rnd.normal(0, 20, (16, 16))
+    x, y = np.meshgrid(np.arange(SHAPE[0]), np.arange(SHAPE[1]), indexing='ij')
+    data += 3e4 * np.exp(-((x - PEAK[0])**2 + (y - PEAK[1])**2) / 2.0)
+
+    ut = ucsftool3.ucsfTool()
+    f = open(path, 'wb')
+    ut.write_ucsf_file_header(f, {'DimCount': 2, 'DataCompCount': 1,
+                                  'FileVersion': 2})
+    for i in range(2):
+        ah = ut.dummy_axis_header()
+        ah['AtomName'] = ['1H', '15N'][i]
+        ah['DataPointCount'] = SHAPE[i]
+        ah['TileSize'] = TILE_SIZE[i]
+        ah['SpecFreq'] = [600.0, 60.8][i]
+        ah['SpecWidth'] = [7000.0, 2000.0][i]
+        ah['Center'] = [4.7, 118.0][i]
+        ut.write_ucsf_axis_header(f, ah)
+    f.write(ucsftool3.tile(data.astype(np.float32), TILE_SIZE)
+            .astype('>f4').tobytes())
+    f.close()
+
+
+def near_peak(tool, peaks):
+    for shifts in peaks:
+        grid = tool.shifts_to_grids(shifts)
+        if all(abs(grid[i] - PEAK[i]) <= 1 for i in range(2)):
+            return True
+    return False
+
+
+@pytest.mark.parametrize('engine', ['numpy', 'stream'])
+def test_weak_peak_in_quiet_tile(tmp_path, engine):
+    path = str(tmp_path / 'quiet.ucsf')
+    write_spectrum(path)
+    tool = ucsftool3.ucsfTool()
+    tool.ucsf_open(path)
+    try:
+        peaks, _ = iPick.pick_peaks(tool, NOISE_LEVEL, [1, 1], sign=1,
+                                    engine=engine)
+        assert not near_peak(tool, peaks)
+        peaks, heights = iPick.pick_peaks(tool, NOISE_LEVEL, [1, 1], sign=1,
+                                          engine=engine, local_noise=True)
+        assert near_peak(tool, peaks)
+        assert min(heights) < NOISE_LEVEL
+    finally:
+        tool.ucsf_close()
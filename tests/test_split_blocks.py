@@ -0,0 +1,36 @@
+"""Blocks of the multiprocess numpy engine"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import ucsftool3
+
+
+def make_tool(shape, tile_size):
+    tool = ucsftool3.ucsfTool()
+    tool.ndim = len(shape)
+    tool.data_point_count = shape
+    tool.tile_size = tile_size
+    tool.tile_count = tuple(-(-shape[i] // tile_size[i])
+                            for i in range(len(shape)))
+    return tool
+
+
+def test_split_other_dims_when_largest_has_one_tile():
+    # the last axis is a single tile but the largest one
+    tool = make_tool((80, 80, 128), (8, 8, 128))
+    blocks = tool.split_blocks(16)
+    assert len(blocks) >= 16
+    covered = 0
+    for lo, hi in blocks:
+        size = 1
+        for i in range(3):
+            size *= hi[i] - lo[i]
+        covered += size
+    assert covered == 80 * 80 * 128
+
+
+def test_split_stops_at_single_tiles():
+    tool = make_tool((16, 16), (8, 8))
+    assert len(tool.split_blocks(100)) == 4
@@ -81,13 +81,31 @@ import itertools
 import datetime
 import multiprocessing
 import math
+import mmap
+import collections
 import tempfile
 import random
+import warnings
+import json
+import hashlib
 random.seed()
 
-tile_count_buffer = 256    # we will hold tile max 256 in memory (approx. 8mb)
-# tile_count_buffer = 4096
-# 128mb # we will hold tile max 512 in memory (approx. 16mb)
+# numpy is optional. Array based engines are used only when it is available.
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+tile_cache_size = 8 * 1024**2    # bytes of tiles held in memory per file object
+block_point_buffer = 4 * 1024**2    # points in a block for the numpy engine (approx. 16mb)
+stream_memory_limit = 256 * 1024**2    # bytes for the streaming peak picker
+noise_sample_count = 1024**2    # points sampled by estimate_noise()
+stats_extension = '.ipick-stats'    # statistics cache next to the spectrum
+lazy_read_ratio = 0.125    # cache a lazily opened file after reading this part
+memory_limit = None    # bytes. Caps the memory budget (see get_memory_budget())
+transform_chunk_count = 4 * 1024**2    # values written at once by write_* functions
+copy_buffer_size = 16 * 1024**2    # bytes per block in copy_file_data()
+log_file = os.path.join(tempfile.gettempdir(), 'process.log')    # see set_log_file()
 unpack_float = struct.Struct('>f').unpack
 unpack_byte = struct.Struct('>B').unpack
 unpack_int = struct.Struct('>I').unpack
@@ -104,11 +122,16 @@ def print_log(*args):
             msg += str(s)
         except:
             msg += '! Could not convert to String'
-    f = open(os.path.join(tempfile.gettempdir(), 'process.log'), 'a')
+    f = open(log_file, 'a')
     f.write(msg + '\n')
     f.close()
     print(*args)
 
+def set_log_file(path):
+    """Write the messages of print_log() to path (e.g. in a job directory)"""
+    global log_file
+    log_file = path
+
 def interpolation(f1, f2, f3):
     a0 = f1
     a1 = -1.5 * f1 + 2.0 * f2 - 0.5 * f3
@@ -150,19 +173,197 @@ def stddev(data, ddof=0):
     pvar = ss/(n-ddof)
     return pvar**0.5
 
-def get_memsize():
-  if OS_WINDOWS:
-    process = os.popen('wmic memorychip get capacity')
-    result = process.read()
-    process.close()
-    totalMem = 0
-    for m in result.split("  \r\n")[1:-1]:
-        totalMem += int(m)
-  elif sys.platform == 'darwin':
-    totalMem = int(os.popen('sysctl hw.memsize').read().strip().split()[1])
-  else:
-    totalMem = int(os.popen('free -tb').readlines()[1].split()[3])
-  return totalMem
+
+def mad_noise(data, clip=3.0, iterations=5):
+    """Median absolute deviation of data after sigma clipping.
+    Points beyond clip * sigma (sigma = 1.4826 * MAD) from the median are
+    removed until nothing changes or iterations run out. For noise around
+    zero, this is the median of absolute values (the scale of sample_noise)
+    without the bias from signals and baseline offsets."""
+    if np is None:
+        data = sorted(data)
+        for _ in range(iterations):
+            med = data[len(data) // 2]
+            mad = sorted(abs(x - med) for x in data)[len(data) // 2]
+            kept = [x for x in data if abs(x - med) <= clip * 1.4826 * mad]
+            if len(kept) == len(data) or len(kept) == 0:
+                break
+            data = kept
+        med = data[len(data) // 2]
+        return sorted(abs(x - med) for x in data)[len(data) // 2]
+    data = np.asarray(data, dtype=np.float64)
+    for _ in range(iterations):
+        med = np.median(data)
+        mad = np.median(np.abs(data - med))
+        kept = data[np.abs(data - med) <= clip * 1.4826 * mad]
+        if len(kept) == len(data) or len(kept) == 0:
+            break
+        data = kept
+    return float(np.median(np.abs(data - np.median(data))))
+
+
+def neighborhood_extreme(box, grid_buffers, func):
+    """Apply func (e.g. numpy.fmax) over the +/- grid_buffers neighborhood
+    of every inner point of box. The box must include the buffer halo, and
+    the returned array has the inner shape. NaN neighbors are ignored."""
+    out = box
+    for axis in range(len(grid_buffers)):
+        b = int(grid_buffers[axis])
+        n = out.shape[axis] - 2 * b
+        sl = [slice(None)] * out.ndim
+        sl[axis] = slice(0, n)
+        acc = out[tuple(sl)]
+        for k in range(1, 2 * b + 1):
+            sl[axis] = slice(k, k + n)
+            acc = func(acc, out[tuple(sl)])
+        out = acc
+    return out
+
+def untile(tiles, tile_size, shape):
+    """Convert tiles shaped (tile counts..., tile sizes...) to a C-ordered
+    array, and cut the marginal points off to the given shape."""
+    ndim = len(tile_size)
+    order = []
+    for i in range(ndim):
+        order += [i, ndim + i]
+    fill_shape = tuple(tiles.shape[i] * tile_size[i] for i in range(ndim))
+    data = tiles.transpose(order).reshape(fill_shape)
+    return np.ascontiguousarray(data[tuple(slice(0, n) for n in shape)])
+
+def tile(data, tile_size):
+    """Convert a C-ordered array to tiles shaped (tile counts...,
+    tile sizes...) in the file order. Marginal points are filled with 0."""
+    ndim = len(tile_size)
+    tile_count = [-(-data.shape[i] // tile_size[i]) for i in range(ndim)]
+    fill = np.zeros([tile_count[i] * tile_size[i] for i in range(ndim)],
+                    dtype=data.dtype)
+    fill[tuple(slice(0, n) for n in data.shape)] = data
+    split_shape = []
+    for i in range(ndim):
+        split_shape += [tile_count[i], tile_size[i]]
+    order = list(range(0, 2 * ndim, 2)) + list(range(1, 2 * ndim, 2))
+    return fill.reshape(split_shape).transpose(order)
+
+def copy_file_data(src, dst, offset, count):
+    """Copy count bytes of src from offset to the current position of dst.
+    The kernel copies the data (copy_file_range or sendfile) if possible,
+    otherwise it is copied in large blocks."""
+    dst.flush()
+    src_fd, dst_fd = src.fileno(), dst.fileno()
+    dst_pos = dst.tell()
+    done = 0
+    for name in ('copy_file_range', 'sendfile'):
+        if not hasattr(os, name):
+            continue
+        try:
+            while done < count:
+                if name == 'copy_file_range':
+                    size = os.copy_file_range(src_fd, dst_fd, count - done,
+                                              offset + done, dst_pos + done)
+                else:
+                    os.lseek(dst_fd, dst_pos + done, os.SEEK_SET)
+                    size = os.sendfile(dst_fd, src_fd, offset + done, count - done)
+                if size == 0:
+                    break
+                done += size
+        except OSError:
+            pass    # not supported for these files. Try the next one.
+        if done == count:
+            break
+    dst.seek(dst_pos + done)
+    src.seek(offset + done)
+    while done < count:
+        temp = src.read(min(copy_buffer_size, count - done))
+        if not temp:
+            break
+        dst.write(temp)
+        done += len(temp)
+    return done
+
+
+def parse_memory_size(text):
+    """Bytes of a memory size text: MB as a plain number, or with a K, M, G
+    or T suffix (e.g. '512', '4G'). None if it is not a size."""
+    text = str(text).strip().upper().rstrip('B')
+    mult = 1024**2
+    for suffix, suffix_mult in (('K', 1024), ('M', 1024**2), ('G', 1024**3),
+                                ('T', 1024**4)):
+        if text.endswith(suffix):
+            text, mult = text[:-1], suffix_mult
+            break
+    try:
+        return int(float(text) * mult)
+    except ValueError:
+        return None
+
+
+def get_available_memory():
+    """Bytes of memory available to new allocations without swapping, read
+    in the process (MemAvailable of /proc/meminfo, GlobalMemoryStatusEx on
+    Windows or sysconf). None if unknown."""
+    if OS_WINDOWS:
+        import ctypes
+
+        class MEMORYSTATUSEX(ctypes.Structure):
+            _fields_ = [('dwLength', ctypes.c_ulong),
+                        ('dwMemoryLoad', ctypes.c_ulong),
+                        ('ullTotalPhys', ctypes.c_ulonglong),
+                        ('ullAvailPhys', ctypes.c_ulonglong),
+                        ('ullTotalPageFile', ctypes.c_ulonglong),
+                        ('ullAvailPageFile', ctypes.c_ulonglong),
+                        ('ullTotalVirtual', ctypes.c_ulonglong),
+                        ('ullAvailVirtual', ctypes.c_ulonglong),
+                        ('ullAvailExtendedVirtual', ctypes.c_ulonglong)]
+        status = MEMORYSTATUSEX()
+        status.dwLength = ctypes.sizeof(MEMORYSTATUSEX)
+        try:
+            if ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+                return int(status.ullAvailPhys)
+        except (AttributeError, OSError):
+            pass
+        return None
+    try:
+        meminfo = {}
+        with open('/proc/meminfo') as f:
+            for line in f:
+                items = line.split()
+                if len(items) >= 2:
+                    meminfo[items[0].rstrip(':')] = int(items[1]) * 1024
+        if 'MemAvailable' in meminfo:
+            return meminfo['MemAvailable']
+        # kernels before 3.14
+        return meminfo['MemFree'] + meminfo.get('Cached', 0) + \
+            meminfo.get('Buffers', 0)
+    except (IOError, OSError, KeyError, ValueError):
+        pass
+    try:
+        # no available pages on macOS. Use half of the physical memory.
+        page_size = os.sysconf('SC_PAGE_SIZE')
+        try:
+            return os.sysconf('SC_AVPHYS_PAGES') * page_size
+        except (ValueError, OSError):
+            return os.sysconf('SC_PHYS_PAGES') * page_size // 2
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def get_memory_budget():
+    """Bytes iPick may use: available memory capped by memory_limit or the
+    IPICK_MEM_LIMIT environment variable (see parse_memory_size()).
+    None if neither is known."""
+    budget = get_available_memory()
+    limit = memory_limit
+    if limit is None and os.environ.get('IPICK_MEM_LIMIT'):
+        limit = parse_memory_size(os.environ['IPICK_MEM_LIMIT'])
+    if limit is not None:
+        budget = limit if budget is None else min(budget, limit)
+    return budget
+
+
+def set_memory_limit(limit):
+    """Cap the memory budget at limit bytes (None for no cap)"""
+    global memory_limit
+    memory_limit = limit
 
 class ucsfTool:
     # ---------------------------------------------------------------------------
@@ -180,6 +381,13 @@ class ucsfTool:
         self.pixel_size = []
         self.min_heights = None
         self.cache_data = None
+        self.tile_cache_size = tile_cache_size
+        self.shared_words = None
+        self.words_offset = 0
+        self.noise_map = None
+        self.cache_pending = False
+        self.lazy_read_size = 0
+        self.tile_cache_stats = {'hit': 0, 'miss': 0, 'eviction': 0}
     # ---------------------------------------------------------------------------
     # Close file and init class
 
@@ -197,7 +405,17 @@ class ucsfTool:
         self.tile_list = []
         self.pixel_size = []
         self.is_opened = 0
+        if isinstance(self.cache_data, mmap.mmap):
+            try:
+                self.cache_data.close()
+            except BufferError:
+                pass    # arrays still refer to the map. Closed when released.
         self.cache_data = None
+        self.shared_words = None
+        self.words_offset = 0
+        self.noise_map = None
+        self.cache_pending = False
+        self.lazy_read_size = 0
 
     # ---------------------------------------------------------------------------
     # Destructor
@@ -210,7 +428,16 @@ class ucsfTool:
     #
     def help(self):
         print_log("""
-        ucsf_open(optional: filename)
+        ucsf_open(optional: filename, nproc=1,
+                  cache_mode=True)  # True, False, 'mmap' or 'lazy'
+        cache_file(cache_mode=True)
+        get_memory_need()
+        get_projection(proj_dim, p_mode=0, sign_mode=0)
+        write_planes_data(out_files, split_dim, reverse, tile_size)
+        write_swapped_data(f, axis1, axis2)
+        lazy_cache(bulk=False, read_size=0)
+        map_data()
+        get_tile_buffer()
         ucsf_close()
         dummy_file_header()
         dummy_axis_header()
@@ -224,6 +451,9 @@ class ucsfTool:
         print_file_info()
         calculate_pixel_size()
         read_tile_data(tile_indices)
+        set_tile_cache_size(cache_size)
+        get_tile_cache_stats()
+        reset_tile_cache_stats()
         grid_to_tile_and_remain_indices(grid_pt)
         optimize_tile_size(axis_header_list)
         tile_and_remain_indices_to_grid(tile_pt, index_pt)
@@ -236,15 +466,36 @@ class ucsfTool:
         points_to_peaks(points):
         get_data(grid_pt)
         get_data_by_shifts(shift_pt)
+        get_linear_data_by_shifts(shift_pts)
         get_interpolated_data(grid_pt, noise_level=None)
         get_interpolated_data_by_shifts(grid_pt)
         get_interpolated_data_by_peaks(peaks)
+        get_interpolated_data_many(grid_pts, noise_level=None)
         sample_noise(sample_count=30)
+        sample_values(sample_count=None, seed=0)
+        estimate_noise(sample_count=None, seed=0, clip=3.0, iterations=5)
+        get_noise_map()
+        get_noise_scale()
+        get_stats_key()
+        get_stats(full=True, use_cache=True)
         filter_peaks_by_count(grid_peaks, heights, max_count)
         filter_peaks_by_height(grid_peaks, heights, max_height)
         is_local_maxima(grid_pt, grid_buffers, sign=1)
         is_local_maxima_by_shifts(shift_pt, shift_buffers, sign=1)
-        find_peaks(noise_level, sign=1, shift_restraint = None)
+        find_peaks(noise_level, sign=1, shift_restraint = None,
+                   engine='python', memory_limit=None, local_noise=False)
+        find_peaks_numpy(noise_level, grid_buffers, sign=1)
+        iter_peaks(noise_level, grid_buffers, sign=1, memory_limit=None)
+        split_blocks(min_count=1)
+        share_words()
+        can_share_words()
+        get_layout()
+        attach_words(layout, words)
+        get_data_many(points)
+        get_data_block(lo, hi)
+        read_tile_rows(start, end)
+        as_array()
+        iter_array(tile_rows=1)
         find_fit_peaks(grid_pt, grid_buffers, sign=1, mode='gaussian')
         find_fit_peaks_by_shifts(shift_pt,
                                  shift_buffers, sign=1, mode='gaussian')
@@ -342,7 +593,8 @@ class ucsfTool:
 
     # ---------------------------------------------------------------------------
     # open ucsf instances and read header and check validity
-    #
+    # cache_mode: True (load or map the data if possible), False, 'mmap' or
+    #             'lazy' (headers only. Caching is decided on data access.)
     def ucsf_open(self, in_filename=None, nproc=1, cache_mode=True):
         if self.is_opened == 1:
             print_log('Error in ucsfTool:ucsf_open()- file is already opened')
@@ -385,7 +637,8 @@ class ucsfTool:
         self.ndim = len(self.axis_header_list)
         self.calculate_pixel_size()
         self.init_pos = 180 + 128 * self.ndim
-        self.tile_list = list(map(lambda x: [], range(nproc)))
+        self.tile_list = list(map(lambda x: collections.OrderedDict(), range(nproc)))
+        self.reset_tile_cache_stats()
 
         self.cube_size = 1  # cube, tile, or 4D cube whatever the size is...
         for i in range(self.ndim):
@@ -393,20 +646,102 @@ class ucsfTool:
         self.cube_float_size = self.cube_size * 4  # cube size in float point size
         self.unpack_cube_float = struct.Struct('>%df' % (self.cube_size)).unpack
 
-        # If memory is enough, load all the data first.
-        # This will be significantly fast when multiprocessing is activated
-        try:
-            free_mem = get_memsize()
-            print('Memory check %d.' % (free_mem))
-            if self.file_size * 3 < free_mem and cache_mode:
-                self.file_object[0].seek(0, 0)
-                self.cache_data = bytes(self.file_object[0].read())
-        except Exception:
+        # strides of tiles in the file and of points in a tile (both C ordered)
+        self.tile_stride = ()
+        self.remain_stride = ()
+        for i in range(self.ndim):
+            tile_mult, remain_mult = 1, 1
+            for j in range(i+1, self.ndim):
+                tile_mult *= self.tile_count[j]
+                remain_mult *= self.tile_size[j]
+            self.tile_stride += (tile_mult,)
+            self.remain_stride += (remain_mult,)
+
+        # Memory-map the file. Pages are shared by all processes through the
+        # OS page cache, and files larger than memory can be accessed.
+        if cache_mode == 'mmap':
+            self.map_data()
+            return
+
+        # Headers only. Caching is decided on data access (see lazy_cache()).
+        if cache_mode == 'lazy':
+            self.cache_pending = True
+            self.lazy_read_size = 0
+            return
+        self.cache_file(cache_mode)
+
+    # ---------------------------------------------------------------------------
+    # Load the whole file in memory if memory is enough, otherwise map it.
+    # This will be significantly fast when multiprocessing is activated
+
+    def cache_file(self, cache_mode=True):
+        if not cache_mode:
+            return
+        budget = get_memory_budget()
+        if budget is None:
             print('Memory check failed.')
-            if self.file_size < 1024**3 and cache_mode:
-                self.file_object[0].seek(0, 0)
-                self.cache_data = bytes(self.file_object[0].read())
-            pass
+            load = self.file_size < 1024**3
+        else:
+            print('Memory check %d.' % (budget))
+            load = self.get_memory_need() < budget
+        if load:
+            self.file_object[0].seek(0, 0)
+            self.cache_data = bytes(self.file_object[0].read())
+        else:
+            self.map_data()
+
+    # ---------------------------------------------------------------------------
+    # Bytes needed to load the file in memory with nproc workers: the data,
+    # the copy shared with the numpy workers, and the tile caches and blocks
+    # of each worker.
+
+    def get_memory_need(self):
+        need = self.file_size
+        if self.nproc > 1 and np is not None:
+            need += self.file_size
+        worker_memory = self.tile_cache_size + 16 * block_point_buffer
+        return need + self.nproc * worker_memory
+
+    # ---------------------------------------------------------------------------
+    # Deferred caching for ucsf_open(cache_mode='lazy')
+    # bulk: the whole file is to be accessed (e.g. find_peaks). Otherwise,
+    # read_size bytes are read by point accesses, and the file is cached when
+    # point accesses have read lazy_read_ratio of the file.
+
+    def lazy_cache(self, bulk=False, read_size=0):
+        if not self.cache_pending:
+            return
+        self.lazy_read_size += read_size
+        if bulk or self.lazy_read_size > self.file_size * lazy_read_ratio:
+            self.cache_pending = False
+            self.cache_file()
+
+    # ---------------------------------------------------------------------------
+    # Memory-map the opened file as cache_data (read only, no copy)
+    #
+    def map_data(self):
+        try:
+            self.cache_data = mmap.mmap(self.file_object[0].fileno(), 0,
+                                        access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            print_log('Error in ucsfTool:map_data()- memory mapping failed')
+            self.cache_data = None
+            return 0
+        return 1
+
+    # ---------------------------------------------------------------------------
+    # Tile region of cache_data as big-endian float32 values without a copy.
+    # numpy array if numpy is available, otherwise a memoryview of bytes.
+    #
+    def get_tile_buffer(self):
+        if self.cache_data is None:
+            print_log('Error in ucsfTool:get_tile_buffer()- data is not cached')
+            return None
+        count = (self.file_size - self.init_pos) // 4
+        if np is None:
+            return memoryview(self.cache_data)[self.init_pos:self.init_pos + count * 4]
+        return np.frombuffer(self.cache_data, dtype='>f4', count=count,
+                             offset=self.init_pos)
 
     # ---------------------------------------------------------------------------
     # Read file header
@@ -588,13 +923,16 @@ class ucsfTool:
     # Get Tile Block
 
     def read_tile_data(self, tile_indices, fd=0):
-        # browse tile list if already read in the memory
-        for i in range(len(self.tile_list[fd])):
-            if self.tile_list[fd][i]['TilePos'] == tile_indices:
-                # move this tile to the top priority
-                if i != 0:
-                    self.tile_list[fd].insert(0, self.tile_list[fd].pop(i))
-                return self.tile_list[fd][0]
+        # look up tile list (LRU ordered) if already read in the memory
+        tile_indices = tuple(tile_indices)
+        tile_cache = self.tile_list[fd]
+        dt = tile_cache.get(tile_indices)
+        if dt is not None:
+            # move this tile to the top priority
+            tile_cache.move_to_end(tile_indices)
+            self.tile_cache_stats['hit'] += 1
+            return dt
+        self.tile_cache_stats['miss'] += 1
 
         # start finding block position for the tile_indices
         sum_size = 0
@@ -615,6 +953,7 @@ class ucsfTool:
             if self.cache_data is None:
                 self.file_object[fd].seek(tile_pos, 0)
                 temp = self.file_object[fd].read(self.cube_float_size)
+                self.lazy_cache(read_size=self.cube_float_size)
             else:
                 temp = self.cache_data[tile_pos:tile_pos+self.cube_float_size]
             dt['Values'] = self.unpack_cube_float(temp)
@@ -622,13 +961,36 @@ class ucsfTool:
             # dt['Values'] = tuple(self.unpack_cube_float(temp))
 
         # make this tile top priority
-        self.tile_list[fd].insert(0, dt)
+        tile_cache[tile_indices] = dt
 
-        # if buffer overflowing, remove last one.
-        if len(self.tile_list[fd]) > tile_count_buffer:
-            self.tile_list[fd].pop(tile_count_buffer)
+        # if buffer overflowing, remove the least recently used one.
+        if len(tile_cache) * self.cube_float_size > self.tile_cache_size and \
+                len(tile_cache) > 1:
+            tile_cache.popitem(last=False)
+            self.tile_cache_stats['eviction'] += 1
         return dt
 
+    # ---------------------------------------------------------------------------
+    # Tile cache size in bytes per file object. Cached tiles over it are dropped.
+
+    def set_tile_cache_size(self, cache_size):
+        self.tile_cache_size = cache_size
+        for tile_cache in self.tile_list:
+            while len(tile_cache) * self.cube_float_size > cache_size and \
+                    len(tile_cache) > 1:
+                tile_cache.popitem(last=False)
+                self.tile_cache_stats['eviction'] += 1
+
+    def get_tile_cache_stats(self):
+        stats = dict(self.tile_cache_stats)
+        stats['tiles'] = sum(map(len, self.tile_list))
+        lookup = stats['hit'] + stats['miss']
+        stats['hit_ratio'] = float(stats['hit']) / lookup if lookup else 0.0
+        return stats
+
+    def reset_tile_cache_stats(self):
+        self.tile_cache_stats = {'hit': 0, 'miss': 0, 'eviction': 0}
+
     # ---------------------------------------------------------------------------
     # Grid to Tile and Index
     #
@@ -647,28 +1009,29 @@ class ucsfTool:
     # Optimize tile size
     #
     def optimize_tile_size(self, axis_header_list):
-        for i in range(self.ndim):
-            axis_header_list[i]['TileSize'] = axis_header_list[i]['DataPointCount'] // 2  # initial starting size
+        for i in range(len(axis_header_list)):
+            # initial starting size
+            axis_header_list[i]['TileSize'] = max(1, axis_header_list[i]['DataPointCount'] // 2)
         # estimate new tile size
         while True:
             # current size?
             temp_size = 4
             max_dim = 0
             max_tilesize = 0
-            for i in range(self.ndim):
+            for i in range(len(axis_header_list)):
                 ts = axis_header_list[i]['TileSize']
                 if ts > max_tilesize:
-                    ts = max_tilesize
+                    max_tilesize = ts
                     max_dim = i
                 temp_size = temp_size * ts
             # check if temp_size <= 32kb
-            if temp_size < 32*1024:
+            if temp_size < 32*1024 or max_tilesize == 1:
                 break
             # reduce the largest dimension
-            axis_header_list[max_dim]['TileSize'] = axis_header_list[max_dim]['TileSize'] // 2
+            axis_header_list[max_dim]['TileSize'] = max_tilesize // 2
 
         # readjust TileCount, FillPointCount, and write axis header
-        for i in range(self.ndim):
+        for i in range(len(axis_header_list)):
             ts = axis_header_list[i]['TileSize']
             axis_header_list[i]['TileCount'] = axis_header_list[i]['DataPointCount'] // ts
             if axis_header_list[i]['DataPointCount'] % ts != 0:
@@ -789,6 +1152,195 @@ class ucsfTool:
             return 0
         return temp
     # ---------------------------------------------------------------------------
+    # Read tile rows [start, end) of the first axis as an array of tiles
+    # shaped (rows, tile counts of other axes..., tile sizes...) (requires numpy)
+    # Tiles beyond the end of file are 0 as read_tile_data() does.
+
+    def read_tile_rows(self, start, end):
+        if self.is_opened == 0:
+            print_log('Error in ucsfTool:read_tile_rows()- file is not opened')
+            return None
+        row_tiles = self.tile_stride[0]
+        tile_count = (end - start) * row_tiles
+        avail_count = (self.file_size - self.init_pos) // self.cube_float_size
+        read_count = max(0, min(tile_count, avail_count - start * row_tiles))
+        pos = self.init_pos + start * row_tiles * self.cube_float_size
+        tiles = np.zeros((tile_count, self.cube_size), dtype=np.float32)
+        if read_count > 0:
+            if self.cache_data is not None:
+                temp = np.frombuffer(self.cache_data, dtype='>f4',
+                                     count=read_count * self.cube_size,
+                                     offset=pos)
+            else:
+                self.file_object[0].seek(pos, 0)
+                temp = np.frombuffer(self.file_object[0].read(
+                    read_count * self.cube_float_size), dtype='>f4')
+            tiles[:read_count] = temp.reshape(read_count, self.cube_size)
+        return tiles.reshape((end - start,) + self.tile_count[1:] + self.tile_size)
+
+    # ---------------------------------------------------------------------------
+    # Whole spectrum as a C-ordered array shaped data_point_count (requires numpy)
+    # Tiles are untiled in one pass and marginal points are dropped.
+
+    def as_array(self):
+        if self.is_opened == 0:
+            print_log('Error in ucsfTool:as_array()- file is not opened')
+            return None
+        self.lazy_cache(bulk=True)
+        return untile(self.read_tile_rows(0, self.tile_count[0]),
+                      self.tile_size, self.data_point_count)
+
+    # ---------------------------------------------------------------------------
+    # Chunked as_array() for files that do not fit in memory.
+    # Yields (first grid index of the first axis, array) for every tile_rows
+    # tile rows of the first axis. Tile rows are contiguous in the file.
+
+    def iter_array(self, tile_rows=1):
+        if self.is_opened == 0:
+            print_log('Error in ucsfTool:iter_array()- file is not opened')
+            return
+        for start in range(0, self.tile_count[0], tile_rows):
+            end = min(start + tile_rows, self.tile_count[0])
+            row_count = min(end * self.tile_size[0], self.data_point_count[0]) \
+                - start * self.tile_size[0]
+            yield start * self.tile_size[0], \
+                untile(self.read_tile_rows(start, end), self.tile_size,
+                       (row_count,) + self.data_point_count[1:])
+
+    # ---------------------------------------------------------------------------
+    # Get Data Values of a grid box [lo, hi) as an array (requires numpy)
+    # Points outside of the spectrum give the same values as get_data().
+
+    def get_data_block(self, lo, hi):
+        if self.is_opened == 0:
+            print_log('Error in ucsfTool:get_data_block()- file is not opened')
+            return None
+        sum_size, remain = 0, 0
+        for i in range(self.ndim):
+            grid = np.arange(lo[i], hi[i], dtype=np.int64)
+            shape = [1] * self.ndim
+            shape[i] = len(grid)
+            sum_size = sum_size + (grid // self.tile_size[i]
+                                   * self.tile_stride[i]).reshape(shape)
+            remain = remain + (grid % self.tile_size[i]
+                               * self.remain_stride[i]).reshape(shape)
+        return self.gather_data(sum_size, remain)
+
+    # ---------------------------------------------------------------------------
+    # Get Data Values of many grid points at once
+    # points: (N, ndim) integer array. Points are grouped by tile and each tile
+    # is decoded once. Points outside of the spectrum give the same values as
+    # get_data(). Returns an N-length float array (a list without numpy).
+
+    def get_data_many(self, points):
+        if self.is_opened == 0:
+            print_log('Error in ucsfTool:get_data_many()- file is not opened')
+            return None
+        if np is None:
+            return [self.get_data(pt) for pt in points]
+        points = np.asarray(points, dtype=np.int64).reshape(-1, self.ndim)
+        sum_size, remain = 0, 0
+        for i in range(self.ndim):
+            sum_size = sum_size + points[:, i] // self.tile_size[i] * self.tile_stride[i]
+            remain = remain + points[:, i] % self.tile_size[i] * self.remain_stride[i]
+        return self.gather_data(sum_size, remain)
+
+    # ---------------------------------------------------------------------------
+    # Whole file as an array of float32 words (requires numpy)
+    # None if the data is neither cached nor shared.
+
+    def get_words(self):
+        if self.shared_words is not None:
+            return self.shared_words
+        if self.cache_data is not None:
+            return np.frombuffer(self.cache_data, dtype='>f4',
+                                 count=self.file_size // 4)
+        return None
+
+    # ---------------------------------------------------------------------------
+    # Decode the whole file once into a shared memory array of float32 words.
+    # Child processes read data from it without their own copies or caches.
+
+    def share_words(self):
+        word_count = self.file_size // 4
+        shared_words = multiprocessing.RawArray('f', word_count)
+        words = np.frombuffer(shared_words, dtype=np.float32)
+        chunk_count = 16 * 1024**2
+        if self.cache_data is not None:
+            words[:] = self.get_words()
+        else:
+            self.file_object[0].seek(0, 0)
+            for start in range(0, word_count, chunk_count):
+                count = min(chunk_count, word_count - start)
+                words[start:start + count] = np.frombuffer(
+                    self.file_object[0].read(count * 4), dtype='>f4')
+        return shared_words
+
+    # ---------------------------------------------------------------------------
+    # Whether share_words() may copy the file: the data is loaded in memory
+    # (cache_file() counted the copy) or the copy fits the memory budget.
+    # Otherwise, child processes map the file and share the page cache.
+
+    def can_share_words(self):
+        if isinstance(self.cache_data, mmap.mmap):
+            return False
+        if self.cache_data is not None:
+            return True
+        budget = get_memory_budget()
+        if budget is None:
+            return self.file_size < 1024**3
+        return self.file_size < budget
+
+    # ---------------------------------------------------------------------------
+    # Tile layout of the opened file. With attach_words(), data can be read
+    # from shared words in other processes without opening the file.
+    # offset: word index of the first word when words are a part of the file.
+
+    def get_layout(self):
+        return {'ndim': self.ndim,
+                'file_size': self.file_size,
+                'init_pos': self.init_pos,
+                'cube_size': self.cube_size,
+                'cube_float_size': self.cube_float_size,
+                'data_point_count': self.data_point_count,
+                'tile_size': self.tile_size,
+                'tile_count': self.tile_count,
+                'tile_stride': self.tile_stride,
+                'remain_stride': self.remain_stride}
+
+    def attach_words(self, layout, words, offset=0):
+        for key in layout:
+            setattr(self, key, layout[key])
+        self.shared_words = words
+        self.words_offset = offset
+        self.is_opened = 1
+
+    # ---------------------------------------------------------------------------
+    # Gather data values by tile offsets and in-tile offsets (array version of
+    # read_tile_data() lookups). Outlier tiles give 0 as read_tile_data() does.
+
+    def gather_data(self, sum_size, remain):
+        sum_size, remain = np.broadcast_arrays(sum_size, remain)
+        tile_pos = self.init_pos + self.cube_float_size * sum_size
+        valid = (tile_pos + self.cube_float_size < self.file_size + 1) & \
+                (tile_pos > 0)
+        values = np.zeros(sum_size.shape, dtype=np.float32)
+        words = self.get_words()
+        if words is not None:
+            values[valid] = words[tile_pos[valid] // 4 + remain[valid]
+                                  - self.words_offset]
+            return values
+        # read each tile only once
+        pos_list, inverse = np.unique(tile_pos[valid], return_inverse=True)
+        tiles = np.empty((len(pos_list), self.cube_size), dtype='>f4')
+        for i in range(len(pos_list)):
+            self.file_object[0].seek(int(pos_list[i]), 0)
+            tiles[i] = np.frombuffer(
+                self.file_object[0].read(self.cube_float_size), dtype='>f4')
+        values[valid] = tiles[inverse.ravel(), remain[valid]]
+        self.lazy_cache(read_size=len(pos_list) * self.cube_float_size)
+        return values
+    # ---------------------------------------------------------------------------
     # Get Data Value by Shifts
 
     def get_data_by_shifts(self, shift_pt):
@@ -802,6 +1354,59 @@ class ucsfTool:
             grid_pt += (self.shift_to_grid(shift_pt[i], i+1), )
         return self.get_data(grid_pt)
 
+    # ---------------------------------------------------------------------------
+    # Linearly interpolated data values at many shift positions
+    # The shifts are converted to fractional grid points (clipped to the
+    # spectrum) and the 2^ndim surrounding grid points of all positions are
+    # gathered at once. Returns a list of values.
+
+    def get_linear_data_by_shifts(self, shift_pts):
+        if self.is_opened == 0:
+            print_log('Error in ucsfTool:get_linear_data_by_shifts()- file is not opened')
+            return None
+        if len(shift_pts) == 0:
+            return []
+
+        lows, fracs = [], []
+        for i in range(self.ndim):
+            ah = self.axis_header_list[i]
+            temp = ah['SpecWidth'] / float(ah['DataPointCount']) / ah['SpecFreq']
+            temp2 = ah['Center'] + (ah['SpecWidth'] / ah['SpecFreq'] / 2.0)
+            last = ah['DataPointCount'] - 1
+            low, frac = [], []
+            for pt in shift_pts:
+                grid = min(max((temp2 - pt[i]) / temp, 0.0), float(last))
+                lo = min(int(grid), max(last - 1, 0))
+                low.append(lo)
+                frac.append(grid - lo)
+            lows.append(low)
+            fracs.append(frac)
+
+        if np is None:
+            values = []
+            for j in range(len(shift_pts)):
+                value = 0.0
+                for corner in itertools.product((0, 1), repeat=self.ndim):
+                    weight = 1.0
+                    for i in range(self.ndim):
+                        weight *= fracs[i][j] if corner[i] else 1.0 - fracs[i][j]
+                    if weight != 0:
+                        grid_pt = [lows[i][j] + corner[i] for i in range(self.ndim)]
+                        value += weight * self.get_data(grid_pt)
+                values.append(value)
+            return values
+
+        low = np.array(lows, dtype=np.int64).T
+        frac = np.array(fracs, dtype=np.float64).T
+        corners = np.array(list(itertools.product((0, 1), repeat=self.ndim)),
+                           dtype=np.int64)
+        # points of all corners: [corner0 of all shifts, corner1 ..., ...]
+        pts = (low[np.newaxis, :, :] + corners[:, np.newaxis, :]).reshape(-1, self.ndim)
+        hts = self.get_data_many(pts).astype(np.float64).reshape(len(corners), -1)
+        weights = np.where(corners[:, np.newaxis, :] == 1,
+                           frac[np.newaxis, :, :], 1.0 - frac[np.newaxis, :, :])
+        return (hts * weights.prod(axis=2)).sum(axis=0).tolist()
+
     # ---------------------------------------------------------------------------
     # Get Interpolated Shift Position and Data Value by Grid Points
 
@@ -848,6 +1453,8 @@ class ucsfTool:
     # Interpolation for peaks
 
     def get_interpolated_data_by_peaks(self, peaks):
+        if np is not None:
+            return self.get_interpolated_data_many(self.peaks_to_points(peaks))
         adj_peaks, adj_hts = [], []
         for i in range(len(peaks)):
             interpolated = self.get_interpolated_data_by_shifts(peaks[i])
@@ -855,19 +1462,278 @@ class ucsfTool:
             adj_hts.append(interpolated[1])
         return adj_peaks, adj_hts
     # ---------------------------------------------------------------------------
+    # Interpolation for many grid points at once
+    # Same as get_interpolated_data() for each point: the center and +/-1
+    # neighbors of all points are gathered at once and the three-point
+    # parabola is solved by array operations. Returns lists of shifts and
+    # values, and both are None for points below noise_level.
+
+    def get_interpolated_data_many(self, grid_pts, noise_level=None):
+        if self.is_opened == 0:
+            print_log('Error in ucsfTool:get_interpolated_data_many()- file is not opened')
+            return None, None
+        if np is None:
+            adj_peaks, adj_hts = [], []
+            for grid_pt in grid_pts:
+                shifts, value = self.get_interpolated_data(grid_pt, noise_level)
+                adj_peaks.append(shifts)
+                adj_hts.append(value)
+            return adj_peaks, adj_hts
+        if len(grid_pts) == 0:
+            return [], []
+
+        pts = np.asarray(grid_pts, dtype=np.int64).reshape(-1, self.ndim)
+        npt = len(pts)
+        d2 = self.get_data_many(pts).astype(np.float64)
+        # prev and next points of all axes: [axis0-1, axis0+1, axis1-1, ...]
+        nbr_pts = np.tile(pts, (2 * self.ndim, 1))
+        for i in range(self.ndim):
+            nbr_pts[2*i*npt:(2*i+1)*npt, i] -= 1
+            nbr_pts[(2*i+1)*npt:(2*i+2)*npt, i] += 1
+        nbr_hts = self.get_data_many(nbr_pts).astype(np.float64)
+
+        shifts = np.empty((npt, self.ndim), dtype=np.float64)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for i in range(self.ndim):
+                d1 = nbr_hts[2*i*npt:(2*i+1)*npt]
+                d3 = nbr_hts[(2*i+1)*npt:(2*i+2)*npt]
+                a1 = -1.5 * d1 + 2.0 * d2 - 0.5 * d3
+                a2 = 0.5 * d1 - d2 + 0.5 * d3
+                pos = -0.5 * a1 / a2
+                value = a2 * pos * pos + a1 * pos + d1
+                # flat or extrapolated- use just middle
+                middle = (a2 == 0) | (pos < 0) | (pos > 2)
+                pos[middle] = 1
+                value[middle] = d2[middle]
+                ah = self.axis_header_list[i]
+                temp = ah['SpecWidth'] / float(ah['DataPointCount']) / ah['SpecFreq']
+                temp2 = ah['Center'] + (ah['SpecWidth'] / ah['SpecFreq'] / 2.0)
+                shifts[:, i] = temp2 - temp * (pts[:, i] + pos - 1.0)
+
+        if noise_level:
+            below = np.abs(d2) < abs(noise_level)
+        else:
+            below = np.zeros(npt, dtype=bool)
+        shift_list = shifts.tolist()
+        value_list = value.tolist()
+        adj_peaks, adj_hts = [], []
+        for i in range(npt):
+            if below[i]:
+                adj_peaks.append(None)
+                adj_hts.append(None)
+            else:
+                adj_peaks.append(shift_list[i])
+                adj_hts.append(value_list[i])
+        return adj_peaks, adj_hts
+    # ---------------------------------------------------------------------------
     # Take the median value of randomly sampled data absolute values.
 
     def sample_noise(self, sample_count=30):
         ahl = self.axis_header_list
-        ht_list = []
+        pt_list = []
         for _ in range(sample_count):
             grid_pt = []
             for j in range(len(ahl)):
                 grid_pt.append(random.randrange(0, ahl[j]['DataPointCount']))
-            ht_list.append(abs(self.get_data(grid_pt)))
+            pt_list.append(grid_pt)
+        ht_list = list(map(lambda x: abs(float(x)), self.get_data_many(pt_list)))
         sorted_ht_list = sorted(ht_list)
         return sorted_ht_list[int(sample_count / 2)]
     # ---------------------------------------------------------------------------
+    # Sample data values for statistics
+    # Memory-resident data is sampled with a stride over the whole file (all
+    # points if not more than sample_count). Otherwise, whole tiles are
+    # sampled at random with the seed, and each tile is read with one seek.
+    # Marginal and zero points are excluded. Without numpy, a list of up to
+    # 10000 random points.
+
+    def sample_values(self, sample_count=None, seed=0):
+        if self.is_opened == 0:
+            print_log('Error in ucsfTool:sample_values()- file is not opened')
+            return []
+        if sample_count is None:
+            sample_count = noise_sample_count
+        total_tiles = 1
+        for i in range(self.ndim):
+            total_tiles *= self.tile_count[i]
+        if np is None:
+            rand = random.Random(seed)
+            pt_list = []
+            for _ in range(min(sample_count, 10000)):
+                pt_list.append([rand.randrange(0, n) for n in self.data_point_count])
+            return [x for x in self.get_data_many(pt_list) if x != 0]
+
+        if not isinstance(self.cache_data, mmap.mmap) and \
+                (self.cache_data is not None or self.shared_words is not None):
+            words = self.get_words()[self.init_pos // 4:]
+            words = words[:total_tiles * self.cube_size]
+            step = max(1, -(-len(words) // sample_count))
+            values = words[::step].astype(np.float32)
+        else:
+            tile_count = min(total_tiles, -(-sample_count // self.cube_size))
+            rand = np.random.RandomState(seed)
+            tiles = np.sort(rand.choice(total_tiles, tile_count, replace=False))
+            remain = np.arange(self.cube_size, dtype=np.int64)
+            values = self.gather_data(tiles.astype(np.int64)[:, None],
+                                      remain[None, :])
+            # drop marginal points of the tiles at the ends
+            inside = np.ones(values.shape, dtype=bool)
+            tile_idx = np.unravel_index(tiles, self.tile_count)
+            remain_idx = np.unravel_index(remain, self.tile_size)
+            for i in range(self.ndim):
+                grid = tile_idx[i][:, None] * self.tile_size[i] + remain_idx[i][None, :]
+                inside &= grid < self.data_point_count[i]
+            values = values[inside]
+        return values[values != 0]
+
+    # ---------------------------------------------------------------------------
+    # Robust noise level from many points at once
+    # mad_noise() of sample_values(), so the same multiplier as sample_noise()
+    # (e.g. 8.5) applies. The result is the same for the same seed.
+
+    def estimate_noise(self, sample_count=None, seed=0, clip=3.0,
+                       iterations=5):
+        if self.is_opened == 0:
+            print_log('Error in ucsfTool:estimate_noise()- file is not opened')
+            return 0
+        values = self.sample_values(sample_count, seed)
+        if len(values) == 0:
+            return 0
+        return mad_noise(values, clip, iterations)
+
+    # ---------------------------------------------------------------------------
+    # Noise map: median absolute deviation of every tile (requires numpy)
+    # Array shaped tile_count, made in one pass over the tile rows. Marginal
+    # and zero points are excluded, and tiles without data are NaN.
+
+    def get_noise_map(self, verbose=False):
+        if self.is_opened == 0:
+            print_log('Error in ucsfTool:get_noise_map()- file is not opened')
+            return None
+        if self.noise_map is not None:
+            return self.noise_map
+        if verbose:
+            print_log(datetime.datetime.now())
+            print_log('Making the noise map of %d tiles' % (
+                self.tile_count[0] * self.tile_stride[0]))
+        row_tiles = self.tile_stride[0]
+        row_count = max(1, block_point_buffer // (row_tiles * self.cube_size))
+        remain_idx = np.unravel_index(np.arange(self.cube_size), self.tile_size)
+        mad_list = []
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)    # empty tiles
+            for start in range(0, self.tile_count[0], row_count):
+                end = min(start + row_count, self.tile_count[0])
+                tiles = self.read_tile_rows(start, end).reshape(-1, self.cube_size)
+                tile_idx = np.unravel_index(
+                    np.arange(start * row_tiles, end * row_tiles), self.tile_count)
+                inside = tiles != 0
+                for i in range(self.ndim):
+                    inside &= tile_idx[i][:, None] * self.tile_size[i] + \
+                        remain_idx[i][None, :] < self.data_point_count[i]
+                tiles = np.where(inside, tiles, np.nan)
+                med = np.nanmedian(tiles, axis=1)
+                mad_list.append(np.nanmedian(np.abs(tiles - med[:, None]), axis=1))
+        self.noise_map = np.concatenate(mad_list).reshape(self.tile_count)
+        return self.noise_map
+
+    # ---------------------------------------------------------------------------
+    # Noise level multipliers of the tiles: noise map / median of the map
+    # Tiles without data or noise use 1 (the global noise level).
+
+    def get_noise_scale(self, verbose=False):
+        noise_map = self.get_noise_map(verbose)
+        if noise_map is None:
+            return None
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            noise_scale = noise_map / np.nanmedian(noise_map)
+        noise_scale[~(noise_scale > 0)] = 1.0
+        return noise_scale
+
+    # ---------------------------------------------------------------------------
+    # Key of the file contents for the statistics cache
+    # File size, modification time and a hash of the headers and 16 blocks
+    # spread over the file.
+
+    def get_stats_key(self):
+        if self.is_opened == 0:
+            print_log('Error in ucsfTool:get_stats_key()- file is not opened')
+            return None
+        block_size = 64 * 1024
+        digest = hashlib.sha1()
+        f = self.file_object[0]
+        f.seek(0, 0)
+        digest.update(f.read(self.init_pos))
+        for i in range(16):
+            f.seek(self.init_pos + (self.file_size - self.init_pos) * i // 16, 0)
+            digest.update(f.read(block_size))
+        return {'size': self.file_size,
+                'mtime': os.path.getmtime(self.file_name),
+                'hash': digest.hexdigest()}
+
+    # ---------------------------------------------------------------------------
+    # Statistics of the spectrum, cached in <file name>.ipick-stats (JSON)
+    # noise: estimate_noise(), percentiles: of sample_values()
+    # full: also the minimum, maximum and the extrema along each axis
+    #       ('axis_max', 'axis_min': lists for the grid points of each axis)
+    #       in one pass over the file.
+    # The cache is used if the key (get_stats_key()) is the same, so
+    # rewritten files are computed again.
+
+    def get_stats(self, full=True, use_cache=True):
+        if self.is_opened == 0:
+            print_log('Error in ucsfTool:get_stats()- file is not opened')
+            return None
+        key = self.get_stats_key()
+        stats_filename = self.file_name + stats_extension
+        stats = None
+        if use_cache:
+            try:
+                with open(stats_filename, 'r') as f:
+                    stats = json.load(f)
+                if stats.get('key') != key:
+                    stats = None
+            except (IOError, OSError, ValueError, AttributeError):
+                stats = None
+        if stats is not None and (not full or 'max' in stats):
+            return stats
+
+        if stats is None:
+            stats = {'key': key}
+            values = self.sample_values()
+            stats['noise'] = mad_noise(values) if len(values) != 0 else 0
+            if np is not None and len(values) != 0:
+                levels = [0.1, 1, 5, 25, 50, 75, 95, 99, 99.9]
+                stats['percentiles'] = dict(zip(map(str, levels),
+                    np.percentile(values, levels).tolist()))
+        if full and np is not None:
+            axis_max = [np.full(n, -np.inf) for n in self.data_point_count]
+            axis_min = [np.full(n, np.inf) for n in self.data_point_count]
+            row_count = max(1, block_point_buffer //
+                            (self.tile_stride[0] * self.cube_size))
+            for start, data in self.iter_array(row_count):
+                rows = slice(start, start + data.shape[0])
+                for i in range(self.ndim):
+                    other = tuple(j for j in range(self.ndim) if j != i)
+                    if i == 0:
+                        axis_max[0][rows] = data.max(axis=other)
+                        axis_min[0][rows] = data.min(axis=other)
+                    else:
+                        axis_max[i] = np.maximum(axis_max[i], data.max(axis=other))
+                        axis_min[i] = np.minimum(axis_min[i], data.min(axis=other))
+            stats['max'] = float(axis_max[0].max())
+            stats['min'] = float(axis_min[0].min())
+            stats['axis_max'] = [x.tolist() for x in axis_max]
+            stats['axis_min'] = [x.tolist() for x in axis_min]
+        try:
+            with open(stats_filename, 'w') as f:
+                json.dump(stats, f)
+        except (IOError, OSError):
+            pass    # read only directory. Computed again next time.
+        return stats
+
+    # ---------------------------------------------------------------------------
     # Check if this grid is the maximum
 
     def is_local_maxima(self, grid_pt, grid_buffers, sign=1, ref_ht=None,
@@ -1001,9 +1867,37 @@ class ucsfTool:
 
     # ---------------------------------------------------------------------------
     # Find peaks in entire spectrum
+    # engine: 'python' (point by point), 'numpy' (whole-array operations)
+    #         or 'stream' (numpy in bounded memory, see iter_peaks())
+    # local_noise: scale noise_level by the local noise (see get_noise_scale())
+    #              Requires numpy. The python engine uses the numpy engine.
     def find_peaks(self, noise_level, grid_buffers, sign=1,
                    shift_restraint=None, shift_grid_buffers=None,
-                   max_count=None, verbose=True):
+                   max_count=None, verbose=True, engine='python',
+                   memory_limit=None, local_noise=False):
+        if local_noise and engine == 'python' and np is not None:
+            engine = 'numpy'
+        if engine != 'stream':
+            self.lazy_cache(bulk=True)
+        if engine == 'numpy':
+            if np is not None:
+                return self.find_peaks_numpy(noise_level, grid_buffers, sign,
+                                             shift_restraint, shift_grid_buffers,
+                                             max_count, verbose, local_noise)
+            print_log('numpy is not available. Using the python engine.')
+        elif engine == 'stream':
+            if np is not None:
+                grid_peaks, heights = [], []
+                for grid_pt, ht in self.iter_peaks(noise_level, grid_buffers,
+                        sign, shift_restraint, shift_grid_buffers, max_count,
+                        memory_limit, verbose, local_noise):
+                    grid_peaks.append(grid_pt)
+                    heights.append(ht)
+                if verbose:
+                    print_log(datetime.datetime.now())
+                    print_log('Find peaks: %d peaks' % (len(grid_peaks)))
+                return grid_peaks, heights
+            print_log('numpy is not available. Using the python engine.')
         ahl = self.axis_header_list
 
         if shift_grid_buffers is None:
@@ -1133,6 +2027,388 @@ class ucsfTool:
             heights += hts
         q.put([peaks, heights])
 
+    # ---------------------------------------------------------------------------
+    # Find peaks in entire spectrum by numpy
+    # The spectrum is processed in blocks of the first axis. For each block,
+    # threshold and local maxima masks are made by whole-array operations, and
+    # the result is the same as find_peaks() with the python engine.
+    def find_peaks_numpy(self, noise_level, grid_buffers, sign=1,
+                         shift_restraint=None, shift_grid_buffers=None,
+                         max_count=None, verbose=True, local_noise=False):
+        self.lazy_cache(bulk=True)
+        grid_buffers = tuple(map(int, grid_buffers))
+        if shift_grid_buffers is None:
+            shift_grid_buffers = grid_buffers
+        grid_restraint = self.shift_restraint_to_grid_restraint(shift_restraint,
+                                                                shift_grid_buffers)
+        noise_scale = None
+        if local_noise:
+            noise_scale = self.get_noise_scale(verbose)
+        if verbose:
+            print_log(datetime.datetime.now())
+            print_log('Finding local maxima by numpy')
+
+        # rows of the first axis in a block
+        row_size = 1
+        for i in range(1, self.ndim):
+            row_size *= self.data_point_count[i] + 2 * grid_buffers[i]
+        row_count = max(1, block_point_buffer // row_size)
+
+        multi = self.nproc > 1 and not OS_WINDOWS
+        if multi:
+            # tile aligned blocks in all dimensions, several per process
+            blocks = self.split_blocks(4 * self.nproc)
+        else:
+            blocks = []
+            for start in range(0, self.data_point_count[0], row_count):
+                lo = [start] + [0] * (self.ndim - 1)
+                hi = [min(start + row_count, self.data_point_count[0])] + \
+                    list(self.data_point_count[1:])
+                blocks.append((lo, hi))
+
+        if multi:
+            results = self.find_local_maxima_shared(blocks, noise_level,
+                                                    grid_buffers, sign,
+                                                    grid_restraint, verbose,
+                                                    noise_scale)
+        else:
+            results = []
+            for lo, hi in blocks:
+                results.append(self.find_local_maxima_block(
+                    lo, hi, noise_level, grid_buffers, sign, grid_restraint,
+                    noise_scale))
+                if verbose:
+                    print_log('Find peaks: %d / %d (%3d %%)' % (hi[0],
+                        self.data_point_count[0], 100 * hi[0] // self.data_point_count[0]))
+        idx_list, hts_list, max_list = [], [], []
+        for idx, hts, is_max in results:
+            idx_list.append(idx)
+            hts_list.append(hts)
+            max_list.append(is_max)
+        idx = np.concatenate(idx_list)
+        hts = np.concatenate(hts_list)
+        is_max = np.concatenate(max_list)
+        if multi:
+            # back to the grid order
+            order = np.argsort(idx, kind='stable')
+            idx, hts, is_max = idx[order], hts[order], is_max[order]
+
+        grid_peaks, heights = self.select_peaks(idx, hts, is_max,
+                                                noise_level, grid_buffers,
+                                                max_count, None, noise_scale)
+        if verbose:
+            print_log(datetime.datetime.now())
+            print_log('Find peaks: %d peaks' % (len(grid_peaks)))
+        return grid_peaks, heights
+
+    # ---------------------------------------------------------------------------
+    # Split the spectrum into tile aligned blocks [lo, hi) in all dimensions.
+    # The largest dimension that still has more than one tile in a block is
+    # halved until there are at least min_count blocks and a block has no
+    # more than block_point_buffer points, or no dimension can be split.
+    def split_blocks(self, min_count=1):
+        block_tiles = list(self.tile_count)
+        while True:
+            block_count, point_count = 1, 1
+            for i in range(self.ndim):
+                block_count *= -(-self.tile_count[i] // block_tiles[i])
+                point_count *= block_tiles[i] * self.tile_size[i]
+            if block_count >= min_count and point_count <= block_point_buffer:
+                break
+            dims = [i for i in range(self.ndim) if block_tiles[i] > 1]
+            if len(dims) == 0:
+                break
+            max_dim = max(dims, key=lambda x: block_tiles[x] * self.tile_size[x])
+            block_tiles[max_dim] = -(-block_tiles[max_dim] // 2)
+
+        ranges = []
+        for i in range(self.ndim):
+            block_size = block_tiles[i] * self.tile_size[i]
+            ranges.append([(x, min(x + block_size, self.data_point_count[i]))
+                           for x in range(0, self.data_point_count[i], block_size)])
+        blocks = []
+        for block in itertools.product(*ranges):
+            blocks.append(([x[0] for x in block], [x[1] for x in block]))
+        return blocks
+
+    # ---------------------------------------------------------------------------
+    # find_local_maxima_block() for blocks by multiple processes
+    # The spectrum is decoded once in shared memory (or mapped by each process
+    # if the copy does not fit, see can_share_words()) and processes get only
+    # the block ranges. Processes pull the blocks from a task queue as they
+    # become free, and results come back as int32 points and float32 heights.
+    def find_local_maxima_shared(self, blocks, noise_level, grid_buffers,
+                                 sign=1, grid_restraint=None, verbose=True,
+                                 noise_scale=None):
+        if self.can_share_words():
+            if verbose:
+                print_log('Sharing decoded data with %d processes' % (self.nproc))
+            shared_words = self.share_words()
+        else:
+            if verbose:
+                print_log('Mapping the file in %d processes' % (self.nproc))
+            shared_words = None
+        if verbose:
+            print_log('%d blocks to process' % (len(blocks)))
+        tasks = []
+        for j in range(len(blocks)):
+            tasks.append((j, blocks[j][0], blocks[j][1], noise_level,
+                          grid_buffers, sign, grid_restraint))
+        results = [None] * len(blocks)
+        pool = multiprocessing.Pool(self.nproc,
+                                    initializer=init_shared_process,
+                                    initargs=(shared_words, self.get_layout(),
+                                              noise_scale, self.file_name))
+        try:
+            cur_percent = -1
+            done_count = 0
+            for j, pts, hts, is_max in pool.imap_unordered(
+                    process_find_local_maxima_shared, tasks):
+                if len(pts) == 0:
+                    idx = np.zeros(0, dtype=np.int64)
+                else:
+                    idx = np.ravel_multi_index(tuple(pts.T.astype(np.int64)),
+                                               self.data_point_count)
+                results[j] = (idx, hts, is_max)
+                done_count += 1
+                tmp_percent = done_count * 10 // len(blocks)
+                if verbose and tmp_percent > cur_percent:
+                    cur_percent = tmp_percent
+                    print_log('Find peaks: %d / %d (%3d %%)' % (done_count,
+                              len(blocks), cur_percent * 10))
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+        return results
+
+    # ---------------------------------------------------------------------------
+    # Find points above noise level and if they are local maxima in [lo, hi)
+    # Returns flat indices of the points, their heights and local maxima flags.
+    # noise_scale: noise level multipliers of the tiles (see get_noise_scale())
+    def find_local_maxima_block(self, lo, hi, noise_level, grid_buffers,
+                                sign=1, grid_restraint=None, noise_scale=None):
+        ahts = abs(noise_level)
+        if noise_scale is not None:
+            tiles = [np.arange(lo[i], hi[i]) // self.tile_size[i]
+                     for i in range(self.ndim)]
+            ahts = ahts * noise_scale[np.ix_(*tiles)]
+        box = self.get_data_block([lo[i] - grid_buffers[i] for i in range(self.ndim)],
+                                  [hi[i] + grid_buffers[i] for i in range(self.ndim)])
+        inner = tuple(slice(grid_buffers[i], grid_buffers[i] + hi[i] - lo[i])
+                      for i in range(self.ndim))
+        values = box[inner]
+        if sign == 1:
+            cand = values >= ahts
+            is_max = ~(neighborhood_extreme(box, grid_buffers, np.fmax) > values)
+        elif sign == -1:
+            cand = values <= -ahts
+            is_max = ~(neighborhood_extreme(box, grid_buffers, np.fmin) < values)
+        else:
+            avalues = np.abs(values)
+            cand = avalues >= ahts
+            is_max = ~(neighborhood_extreme(np.abs(box), grid_buffers,
+                                            np.fmax) > avalues)
+        if grid_restraint is not None:
+            for i in range(self.ndim):
+                axis_mask = np.zeros(self.data_point_count[i], dtype=bool)
+                grids = [g for g in grid_restraint[i]
+                         if 0 <= g < self.data_point_count[i]]
+                axis_mask[grids] = True
+                shape = [1] * self.ndim
+                shape[i] = hi[i] - lo[i]
+                cand &= axis_mask[lo[i]:hi[i]].reshape(shape)
+        pts = np.nonzero(cand)
+        idx = np.ravel_multi_index(tuple(pts[i] + lo[i] for i in range(self.ndim)),
+                                   self.data_point_count)
+        return idx, values[cand], is_max[cand]
+
+    # ---------------------------------------------------------------------------
+    # Select peaks from local maxima candidates in the order the python engine
+    # visits them: per-process x ranges, chunks of 100000 points, skipping a
+    # maximum next to the previous peak, and max_count height cut-off.
+    # noise_scale: noise level multipliers of the tiles (see get_noise_scale())
+    def select_peaks(self, idx, hts, is_max, noise_level, grid_buffers,
+                     max_count=None, state=None, noise_scale=None):
+        ahts = abs(noise_level)
+        sgb = sum(grid_buffers)
+        chunk_size = 100000
+        if max_count is None:
+            max_count = 1000  # maximum peak in a chunk
+        # state carries the selection over the calls for consecutive
+        # candidates in grid order (streaming)
+        if state is None:
+            state = {}
+        if len(state) == 0:
+            state.update({'pnum': None, 'chunk': None, 'min_height': 10**10,
+                          'count': 0, 'tf': False, 'prev_pt': None,
+                          'prev_ht': None, 'prev_aht': ahts, 'gap': -np.inf})
+
+        # process number and the chunk of each point
+        row_size = 1
+        for i in range(1, self.ndim):
+            row_size *= self.data_point_count[i]
+        x_start = [0] * self.nproc
+        for x in range(self.data_point_count[0] - 1, -1, -1):
+            x_start[min(int(float(x) / self.fd_divider), self.nproc-1)] = x
+        xs = idx // row_size
+        pnum = np.minimum((xs / self.fd_divider).astype(np.int64), self.nproc-1)
+        local = (xs - np.array(x_start, dtype=np.int64)[pnum]) * row_size \
+            + idx % row_size
+        chunk = pnum * (self.file_size + 1) + local // chunk_size
+
+        nonmax = np.where(is_max, -np.inf, np.abs(hts))
+        mpos = np.nonzero(is_max)[0]
+        if len(mpos) == 0:
+            if len(nonmax) != 0:
+                state['gap'] = max(state['gap'], float(nonmax.max()))
+            return [], []
+        # largest height of non-maxima between two maxima
+        gap = np.maximum.reduceat(nonmax, mpos)
+        if mpos[0] != 0:
+            state['gap'] = max(state['gap'], float(nonmax[:mpos[0]].max()))
+        pts = np.transpose(np.unravel_index(idx[mpos], self.data_point_count))
+        # noise level at the maxima
+        if noise_scale is not None:
+            tiles = tuple(pts[:, i] // self.tile_size[i] for i in range(self.ndim))
+            ahts_list = (ahts * noise_scale[tiles]).tolist()
+        else:
+            ahts_list = [ahts] * len(mpos)
+
+        grid_peaks, heights = [], []
+        cur_pnum, cur_chunk = state['pnum'], state['chunk']
+        min_height, count = state['min_height'], state['count']
+        tf, prev_pt, prev_ht = state['tf'], state['prev_pt'], state['prev_ht']
+        prev_aht = state['prev_aht']
+        for k in range(len(mpos)):
+            pos = mpos[k]
+            prev_gap = gap[k-1] if k != 0 else state['gap']
+            if pnum[pos] != cur_pnum:
+                cur_pnum = pnum[pos]
+                min_height = 10**10
+            if chunk[pos] != cur_chunk:
+                cur_chunk = chunk[pos]
+                count, tf, prev_pt, prev_ht = 0, False, None, None
+            elif prev_gap > -np.inf and \
+                    (count <= max_count or prev_gap >= min_height):
+                tf = False
+            ht = float(hts[pos])
+            if count > max_count and abs(ht) < min_height:
+                continue
+            grid_pt = tuple(map(int, pts[k]))
+            if tf:
+                diff = 0
+                for j in range(len(grid_buffers)):
+                    diff += abs(prev_pt[j] - grid_pt[j])
+                if diff < sgb and abs(prev_ht) > prev_aht:
+                    continue
+            grid_peaks.append(grid_pt)
+            heights.append(ht)
+            prev_pt, prev_ht, prev_aht = grid_pt, ht, ahts_list[k]
+            count += 1
+            tf = True
+            min_height = min(min_height, abs(ht))
+        state.update({'pnum': cur_pnum, 'chunk': cur_chunk,
+                      'min_height': min_height, 'count': count, 'tf': tf,
+                      'prev_pt': prev_pt, 'prev_ht': prev_ht,
+                      'prev_aht': prev_aht, 'gap': float(gap[-1])})
+        return grid_peaks, heights
+
+    # ---------------------------------------------------------------------------
+    # Streaming peak picker for spectra larger than memory (requires numpy)
+    # Yields (grid_pt, height) in grid order. Blocks of first-axis tile rows
+    # are processed with a halo of neighbor tiles, keeping only a window of
+    # decoded data. The file is read once from the start to the end (and
+    # once more before that for the noise map with local_noise).
+    # memory_limit: approximate bytes used for the window and the block.
+    # The peaks are the same as find_peaks() gives.
+
+    def iter_peaks(self, noise_level, grid_buffers, sign=1,
+                   shift_restraint=None, shift_grid_buffers=None,
+                   max_count=None, memory_limit=None, verbose=True,
+                   local_noise=False):
+        if self.is_opened == 0:
+            print_log('Error in ucsfTool:iter_peaks()- file is not opened')
+            return
+        if np is None:
+            print_log('Error in ucsfTool:iter_peaks()- numpy is not available')
+            return
+        grid_buffers = tuple(map(int, grid_buffers))
+        if shift_grid_buffers is None:
+            shift_grid_buffers = grid_buffers
+        grid_restraint = self.shift_restraint_to_grid_restraint(shift_restraint,
+                                                                shift_grid_buffers)
+        if memory_limit is None:
+            memory_limit = stream_memory_limit
+        noise_scale = None
+        if local_noise:
+            noise_scale = self.get_noise_scale(verbose)
+
+        # tile rows in a block: words of a tile row and about 48 bytes per
+        # block point for the box, tile offsets and neighborhood filters
+        row_words = self.tile_stride[0] * self.cube_size
+        row_points = self.tile_size[0]
+        for i in range(1, self.ndim):
+            row_points *= self.data_point_count[i] + 2 * grid_buffers[i]
+        halo_rows = 2 * (-(-grid_buffers[0] // self.tile_size[0])) + 2
+        row_count = max(1, memory_limit // (8 * row_words + 48 * row_points)
+                        - halo_rows)
+        if verbose:
+            print_log(datetime.datetime.now())
+            print_log('Streaming %d tile rows per block' % (row_count))
+
+        file_words = self.file_size // 4
+        init_word = self.init_pos // 4
+        window = np.zeros(0, dtype=np.float32)
+        window_start = 0    # word index of window[0]
+        reader = ucsfTool()
+        state = {}
+        for start in range(0, self.tile_count[0], row_count):
+            lo = [start * self.tile_size[0]] + [0] * (self.ndim - 1)
+            hi = [min((start + row_count) * self.tile_size[0],
+                      self.data_point_count[0])] + list(self.data_point_count[1:])
+            # words of the tiles the block and its halo refer to
+            min_sum, max_sum = 0, 0
+            for i in range(self.ndim):
+                min_sum += (lo[i] - grid_buffers[i]) // self.tile_size[i] \
+                    * self.tile_stride[i]
+                max_sum += (hi[i] - 1 + grid_buffers[i]) // self.tile_size[i] \
+                    * self.tile_stride[i]
+            word_lo = min(max(0, init_word + min_sum * self.cube_size), file_words)
+            word_hi = min(max(0, init_word + (max_sum + 1) * self.cube_size),
+                          file_words)
+            word_lo = max(word_lo, window_start)
+            # slide the window. Only new words are read.
+            window_end = window_start + len(window)
+            if word_hi > window_end:
+                count = word_hi - window_end
+                if self.cache_data is not None:
+                    new_words = np.frombuffer(self.cache_data, dtype='>f4',
+                                              count=count, offset=window_end * 4)
+                else:
+                    self.file_object[0].seek(window_end * 4, 0)
+                    new_words = np.frombuffer(
+                        self.file_object[0].read(count * 4), dtype='>f4')
+                window = np.concatenate((window[word_lo - window_start:],
+                                         new_words.astype(np.float32)))
+            else:
+                window = window[word_lo - window_start:]
+            window_start = word_lo
+            reader.attach_words(self.get_layout(), window, window_start)
+
+            idx, hts, is_max = reader.find_local_maxima_block(
+                lo, hi, noise_level, grid_buffers, sign, grid_restraint,
+                noise_scale)
+            grid_peaks, heights = self.select_peaks(idx, hts, is_max,
+                                                    noise_level, grid_buffers,
+                                                    max_count, state,
+                                                    noise_scale)
+            if verbose:
+                print_log('Find peaks: %d / %d (%3d %%)' % (hi[0],
+                    self.data_point_count[0], 100 * hi[0] // self.data_point_count[0]))
+            for i in range(len(grid_peaks)):
+                yield grid_peaks[i], heights[i]
+
     # ---------------------------------------------------------------------------
     # Find peaks in entire spectrum
     """    def find_peaks(self, noise_level, grid_buffers, sign=1,
@@ -1272,7 +2548,7 @@ class ucsfTool:
                         max_count=None, threshold=None, noise_filter=8.,
                         shift_restraint=None, shift_grid_buffers=None,
                         write_peaks=True, verbose=False):
-        noise = self.sample_noise(sample_count=100)
+        noise = self.estimate_noise()
         if threshold is None:
             thresh = int(noise*noise_filter)
         else:
@@ -1302,7 +2578,7 @@ class ucsfTool:
     # Refine sparky peaks
     def refine_sparky_peaks(self, in_filename, out_filename, grid_buffers=None,
                             sign=0, max_count=None, noise_filter=8.):
-        noise = self.sample_noise(sample_count=60)
+        noise = self.estimate_noise()
         noise_level = noise*noise_filter
         if grid_buffers is None:
             g_buffers = list(map(lambda x: 2, range(self.ndim)))
@@ -1429,25 +2705,40 @@ class ucsfTool:
         # write axis header
         for i in range(self.ndim):
             self.write_ucsf_axis_header(f, self.axis_header_list[i])
-        # write data
-        data_count = (self.file_size - (180+128*self.ndim)) // 4
-        self.file_object[0].seek(180+128*self.ndim)
-        for _ in range(data_count):
-            temp = self.file_object[0].read(4)
-            temp2 = struct.unpack('>f', temp)[0]
-            # modify
-            if trans_mode == 0:  # mult
-                temp3 = temp2 * transform_factor
+        # write data in chunks. Values are calculated in double precision and
+        # rounded to float as the point by point calculation did.
+        data_count = (self.file_size - self.init_pos) // 4
+        chunk_count = transform_chunk_count
+        if trans_mode == 3:  # pow
+            factor = transform_factor**transform_factor2
+        else:
+            factor = transform_factor
+        self.file_object[0].seek(self.init_pos)
+        for start in range(0, data_count, chunk_count):
+            count = min(chunk_count, data_count - start)
+            temp = self.file_object[0].read(count * 4)
+            if np is not None:
+                temp2 = np.frombuffer(temp, dtype='>f4').astype(np.float64)
+                if trans_mode == 0 or trans_mode == 3:  # mult, pow
+                    temp3 = temp2 * factor
+                elif trans_mode == 1:  # comb
+                    temp3 = temp2 + factor
+                elif trans_mode == 2:  # subt
+                    temp3 = temp2 - factor
+                elif trans_mode == 4:  # abs
+                    temp3 = np.abs(temp2)
+                f.write(temp3.astype('>f4').tobytes())
+                continue
+            temp2 = struct.unpack('>%df' % (count), temp)
+            if trans_mode == 0 or trans_mode == 3:  # mult, pow
+                temp3 = [x * factor for x in temp2]
             elif trans_mode == 1:  # comb
-                temp3 = temp2 + transform_factor
+                temp3 = [x + factor for x in temp2]
             elif trans_mode == 2:  # subt
-                temp3 = temp2 - transform_factor
-            elif trans_mode == 3:  # pow
-                temp3 = temp2*(transform_factor**transform_factor2)
+                temp3 = [x - factor for x in temp2]
             elif trans_mode == 4:  # abs
-                temp3 = abs(temp2)
-            # f.write(struct.pack('>f', temp3))
-            f.write(pack_float(temp3))
+                temp3 = [abs(x) for x in temp2]
+            f.write(struct.pack('>%df' % (count), *temp3))
         f.close()
 
     # ---------------------------------------------------------------------------
@@ -1520,32 +2811,46 @@ class ucsfTool:
         # and write axis header
         cube_count = 1
         cube_size = 1
-        for i in range(self.ndim):
+        for i in range(len(axis_header_list)):
             self.write_ucsf_axis_header(f, axis_header_list[i])
             cube_count = cube_count * axis_header_list[i]['TileCount']
             cube_size = cube_size * axis_header_list[i]['TileSize']
 
         # write data
+        if np is not None:
+            data = self.get_projection(proj_dim, p_mode, sign_mode)
+            tile_size = [ah['TileSize'] for ah in axis_header_list]
+            f.write(tile(data, tile_size).astype('>f4').tobytes())
+            f.close()
+            return
+
+        out_ndim = len(axis_header_list)
         for i in range(cube_count):
-            cube_grid_pt = [0] * self.ndim
+            cube_grid_pt = [0] * out_ndim
             pos = i
-            for j in range(self.ndim):
-                dim_idx = self.ndim-j-1
+            for j in range(out_ndim):
+                dim_idx = out_ndim-j-1
                 cube_grid_pt[dim_idx] = pos % axis_header_list[dim_idx]['TileCount']
                 pos = pos // axis_header_list[dim_idx]['TileCount']
             for j in range(cube_size):
                 # absolute grid point
-                grid_pt = [0] * self.ndim  # this is absolute position
-                part_grid_pt = [0] * self.ndim
+                grid_pt = [0] * out_ndim  # this is absolute position
+                part_grid_pt = [0] * out_ndim
                 pos = j
-                for k in range(self.ndim):
-                    dim_idx = self.ndim-k-1
+                for k in range(out_ndim):
+                    dim_idx = out_ndim-k-1
                     part_grid_pt[dim_idx] = pos % axis_header_list[dim_idx]['TileSize']
                     pos = pos // axis_header_list[dim_idx]['TileSize']
                 # combine cube pos + part pos
-                for k in range(self.ndim):
+                marginal = False
+                for k in range(out_ndim):
                     grid_pt[k] = cube_grid_pt[k] * axis_header_list[k]['TileSize'] \
                                             + part_grid_pt[k]
+                    if grid_pt[k] >= axis_header_list[k]['DataPointCount']:
+                        marginal = True
+                if marginal:
+                    f.write(pack_float(0))
+                    continue
                 # print grid_pt
                 grid_pt.insert(proj_dim-1, 0)
                 # add increment through project dimension
@@ -1572,9 +2877,60 @@ class ucsfTool:
                 elif p_mode == 3 or p_mode == -1:
                     val = max(value_list)         # max
                 # f.write(struct.pack('>f', val))
-                f.write(pack_float(val))
+                f.write(pack_float(val + 0.0))  # no negative zeros
         f.close()
 
+    # ---------------------------------------------------------------------------
+    # Projection along proj_dim (1, 2, ...) as an array (requires numpy)
+    # p_mode: 0 avg, 1 sum, 2 min, 3 max, -1 max of absolute values
+    # sign_mode: 0 all, 1 positive, 2 negative values only
+    # The spectrum is reduced in chunks of first axis tile rows in double
+    # precision, and points without values give 0.
+
+    def get_projection(self, proj_dim, p_mode=0, sign_mode=0):
+        axis = proj_dim - 1
+        out_shape = [n for i, n in enumerate(self.data_point_count) if i != axis]
+        total = np.zeros(out_shape)
+        count = np.zeros(out_shape, dtype=np.int64)
+        low = np.full(out_shape, np.inf)
+        high = np.full(out_shape, -np.inf)
+        row_count = max(1, block_point_buffer // (self.tile_stride[0] * self.cube_size))
+        for start, data in self.iter_array(row_count):
+            data = data.astype(np.float64)
+            if p_mode == -1:
+                data = np.abs(data)
+            if sign_mode == 1:
+                mask = data > 0
+            elif sign_mode == 2:
+                mask = data < 0
+            else:
+                mask = np.ones(data.shape, dtype=bool)
+            part_total = np.where(mask, data, 0).sum(axis=axis)
+            part_count = mask.sum(axis=axis)
+            part_low = np.where(mask, data, np.inf).min(axis=axis)
+            part_high = np.where(mask, data, -np.inf).max(axis=axis)
+            if axis == 0:
+                total += part_total
+                count += part_count
+                low = np.minimum(low, part_low)
+                high = np.maximum(high, part_high)
+            else:
+                rows = slice(start, start + data.shape[0])
+                total[rows] = part_total
+                count[rows] = part_count
+                low[rows] = part_low
+                high[rows] = part_high
+        if p_mode == 0:
+            data = total / np.maximum(count, 1)
+        elif p_mode == 1:
+            data = total
+        elif p_mode == 2:
+            data = low
+        else:
+            data = high
+        data[count == 0] = 0
+        return data + 0.0   # no negative zeros
+
     # ---------------------------------------------------------------------------
     # Write 2d planes from 3d cube
     #
@@ -1642,23 +2998,25 @@ class ucsfTool:
 
         cube_count = 1
         cube_size = 1
-        for i in range(self.ndim):
+        for i in range(len(axis_header_list)):
             cube_count = cube_count * axis_header_list[i]['TileCount']
             cube_size = cube_size * axis_header_list[i]['TileSize']
 
         # prepare file names
         # check if user input is decimal
         try:
-            temp = int(init)
-            temp = int(gap)
-            int_mode = 1
-        except:
-            int_type = 0
+            int_mode = 0
+            if float(init).is_integer() and float(gap).is_integer():
+                int_mode = 1
+        except (TypeError, ValueError):
+            print_log('Error in ucsfTool:write_planes()- incorrect init or gap')
+            print_log(use_logo)
+            return 0
         out_files = []
         max_num = gap * self.axis_header_list[split_dim-1]['DataPointCount'] + init
         for i in range(self.axis_header_list[split_dim-1]['DataPointCount']):
             if int_mode == 1:
-                tp = gap*i + init
+                tp = int(gap*i + init)
                 if max_num < 10 or max_num >= 100000:
                     out_files.append('%s_%d.ucsf' % (out_prefix, tp))
                 elif max_num < 100:
@@ -1670,7 +3028,7 @@ class ucsfTool:
                 elif max_num < 100000:
                     out_files.append('%s_%05d.ucsf' % (out_prefix, tp))
             else:
-                tp = gap(float(i)) + init
+                tp = gap*float(i) + init
                 if max_num < 10:
                     out_files.append('%s_%05.3f.ucsf' % (out_prefix, tp))
                 elif max_num < 100:
@@ -1688,19 +3046,22 @@ class ucsfTool:
                 print_log(use_logo)
                 return 0
 
+        # write headers
         for i in range(len(out_files)):
-            out_filename = out_files[i]
-
-            f = open(out_filename, 'wb')
-
-            # write header
+            f = open(out_files[i], 'wb')
             self.write_ucsf_file_header(f, file_header)
-
-            # and write axis header
             for j in range(len(axis_header_list)):
                 self.write_ucsf_axis_header(f, axis_header_list[j])
+            f.close()
+
+        # write data
+        if np is not None:
+            self.write_planes_data(out_files, split_dim, reverse,
+                                   [ah['TileSize'] for ah in axis_header_list])
+            return
 
-            # write data
+        for i in range(len(out_files)):
+            f = open(out_files[i], 'ab')
             for j in range(cube_count):
                 cube_grid_pt = [0] * len(axis_header_list)
                 pos = j
@@ -1718,9 +3079,15 @@ class ucsfTool:
                         part_grid_pt[dim_idx] = pos % axis_header_list[dim_idx]['TileSize']
                         pos = pos // axis_header_list[dim_idx]['TileSize']
                     # combine cube pos + part pos
+                    marginal = False
                     for l in range(len(axis_header_list)):
                         grid_pt[l] = cube_grid_pt[l] * axis_header_list[l]['TileSize'] \
                                                 + part_grid_pt[l]
+                        if grid_pt[l] >= axis_header_list[l]['DataPointCount']:
+                            marginal = True
+                    if marginal:
+                        f.write(pack_float(0))
+                        continue
                     # print grid_pt
                     grid_pt.insert(split_dim-1, 0)
                     # add increment through project dimension
@@ -1732,6 +3099,63 @@ class ucsfTool:
                     f.write(struct.pack('>f', val))
             f.close()
 
+    # ---------------------------------------------------------------------------
+    # Data of write_planes() in one pass over the file (requires numpy)
+    # Tile rows of the first axis are read once, and slices of all planes are
+    # re-tiled and appended to the plane files (headers already written).
+    # With the first axis split, the rows are the planes. Otherwise, rows are
+    # written per output tile row, so the output tiles are complete.
+
+    def write_planes_data(self, out_files, split_dim, reverse, tile_size):
+        axis = split_dim - 1
+        plane_count = self.data_point_count[axis]
+        row_count = max(1, block_point_buffer // (self.tile_stride[0] * self.cube_size))
+
+        def plane_file(idx):    # plane index to file index
+            if reverse == 1:
+                return idx
+            return plane_count - idx - 1
+
+        # the plane files stay open while the source is read
+        files = []
+        try:
+            for out_file in out_files:
+                files.append(open(out_file, 'ab'))
+
+            if axis == 0:
+                for start, data in self.iter_array(row_count):
+                    for j in range(data.shape[0]):
+                        files[plane_file(start + j)].write(
+                            tile(data[j], tile_size).astype('>f4').tobytes())
+                return
+
+            # rows in complete output tile rows
+            step = max(1, row_count * self.tile_size[0] // tile_size[0]) * tile_size[0]
+            pending, pending_rows = [], 0
+            for _, data in self.iter_array(row_count):
+                pending.append(data)
+                pending_rows += len(data)
+                if pending_rows < step:
+                    continue
+                rows = np.concatenate(pending)
+                start = 0
+                while pending_rows - start >= step:
+                    self.append_planes(files, rows[start:start + step], axis,
+                                       plane_file, tile_size)
+                    start += step
+                pending, pending_rows = [rows[start:]], pending_rows - start
+            if pending_rows > 0:
+                self.append_planes(files, np.concatenate(pending), axis,
+                                   plane_file, tile_size)
+        finally:
+            for f in files:
+                f.close()
+
+    def append_planes(self, files, data, axis, plane_file, tile_size):
+        for idx in range(data.shape[axis]):
+            files[plane_file(idx)].write(
+                tile(np.take(data, idx, axis=axis), tile_size).astype('>f4').tobytes())
+
     # ---------------------------------------------------------------------------
     # Write axis swapped
     #
@@ -1786,6 +3210,11 @@ class ucsfTool:
             self.write_ucsf_axis_header(f, axis_header_list[i])
 
         # write data
+        if np is not None:
+            self.write_swapped_data(f, dim1-1, dim2-1)
+            f.close()
+            return
+
         for i in range(cube_count):
             cube_grid_pt = [0] * len(axis_header_list)
             pos = i
@@ -1815,6 +3244,45 @@ class ucsfTool:
 
         f.close()
 
+    # ---------------------------------------------------------------------------
+    # Data of write_swapped_axis() as a tile-blocked transpose (requires numpy)
+    # An output tile is the source tile with swapped tile indices, and its
+    # points are the source tile points with swapped in-tile indices. Blocks
+    # of output tile rows are gathered (each source tile read once) and
+    # written in order. The file is the same as the point-by-point one.
+
+    def write_swapped_data(self, f, axis1, axis2):
+        order = list(range(self.ndim))    # source axis of each output axis
+        order[axis1], order[axis2] = order[axis2], order[axis1]
+        out_tile_count = [self.tile_count[x] for x in order]
+
+        # source in-tile offsets of the output in-tile points
+        remain = 0
+        for i in range(self.ndim):
+            shape = [1] * self.ndim
+            shape[i] = self.tile_size[order[i]]
+            remain = remain + (np.arange(self.tile_size[order[i]], dtype=np.int64)
+                               * self.remain_stride[order[i]]).reshape(shape)
+        remain = remain.reshape(1, -1)
+
+        row_tiles = 1
+        for i in range(1, self.ndim):
+            row_tiles *= out_tile_count[i]
+        row_count = max(1, block_point_buffer // (row_tiles * self.cube_size))
+        for start in range(0, out_tile_count[0], row_count):
+            end = min(start + row_count, out_tile_count[0])
+            sum_size = 0
+            for i in range(self.ndim):
+                if i == 0:
+                    idx = np.arange(start, end, dtype=np.int64)
+                else:
+                    idx = np.arange(out_tile_count[i], dtype=np.int64)
+                shape = [1] * self.ndim
+                shape[i] = len(idx)
+                sum_size = sum_size + (idx * self.tile_stride[order[i]]).reshape(shape)
+            values = self.gather_data(sum_size.reshape(-1, 1), remain)
+            f.write(values.astype('>f4').tobytes())
+
     # ---------------------------------------------------------------------------
     # Write shifted
     #
@@ -1869,12 +3337,9 @@ class ucsfTool:
                                                 / float(ah['DataPointCount']-1)
             self.write_ucsf_axis_header(f, ah)
 
-        # write data
-        data_count = (self.file_size - (180+128*len(self.axis_header_list))) // 4
-        self.file_object[0].seek(180+128*len(self.axis_header_list))
-        for i in range(data_count):
-            temp = self.file_object[0].read(4)
-            f.write(temp)
+        # copy data without decoding
+        data_count = (self.file_size - self.init_pos) // 4
+        copy_file_data(self.file_object[0], f, self.init_pos, data_count * 4)
         f.close()
 
     # ---------------------------------------------------------------------------
@@ -1916,6 +3381,36 @@ class ucsfTool:
         f.write(struct.pack('12d', 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0))  # cap 128 bytes
 
 
+shared_ut = None
+shared_noise_scale = None
+
+
+def init_shared_process(shared_words, layout, noise_scale=None, file_name=None):
+    global shared_ut, shared_noise_scale
+    shared_ut = ucsfTool()
+    if shared_words is None:
+        # read only map of the file. Pages are shared by the processes.
+        with open(file_name, 'rb') as f:
+            shared_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        words = np.frombuffer(shared_map, dtype='>f4',
+                              count=layout['file_size'] // 4)
+    else:
+        words = np.frombuffer(shared_words, dtype=np.float32)
+    shared_ut.attach_words(layout, words)
+    shared_noise_scale = noise_scale
+
+
+def process_find_local_maxima_shared(task):
+    j, lo, hi, noise_level, grid_buffers, sign, grid_restraint = task
+    idx, hts, is_max = shared_ut.find_local_maxima_block(lo, hi, noise_level,
+                                                         grid_buffers, sign,
+                                                         grid_restraint,
+                                                         shared_noise_scale)
+    pts = np.array(np.unravel_index(idx, shared_ut.data_point_count),
+                   dtype=np.int32).T
+    return j, pts, hts.astype(np.float32), is_max
+
+
 def auto_picking(in_filename, out_filename=None, grid_buffers=None,
                  noise_filter=8, sign=0, max_count=None,
                  threshold=None, nproc=2, verbose=False):
@@ -1987,11 +3482,6 @@ def auto_picking_3D_proj_method(in_filename, out_filename=None,
 
 
 if __name__ == "__main__":
-  if func != 'find_peaks':
-    print_log('List of available functions:')
-    ut=ucsfTool()
-    ut.help()
-  else:
-    multiprocessing.freeze_support()
-    grid_peaks, grid_hts = ut.find_peaks(noiselevel, grid_buffers=res, sign=sign,
-                              verbose=verbose)
+  print_log('List of available functions:')
+  ut=ucsfTool()
+  ut.help()